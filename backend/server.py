@@ -1,16 +1,19 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, BackgroundTasks
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Request
+from fastapi.responses import FileResponse, StreamingResponse, Response
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
 import logging
 import aiofiles
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple, Callable, Awaitable
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 import requests
 import random
 import re
@@ -19,25 +22,88 @@ from urllib.parse import quote
 from http.cookies import SimpleCookie
 import asyncio
 import json
+import hashlib
+import socket
+import zlib
+import math
+from collections import defaultdict, OrderedDict
+from contextlib import asynccontextmanager
+from tenacity import AsyncRetrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+from urllib3.exceptions import ConnectTimeoutError
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
+# MongoDB connection, opened by the app lifespan rather than at import time
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+MONGO_TIMEOUT_MS = int(os.environ.get("MONGO_TIMEOUT_MS", "5000"))
+client: Optional[AsyncIOMotorClient] = None
+db = None
+
+# Startup progress, reported by /api/health/ready
+app_state = {"indexes_ready": False}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await start_app()
+    try:
+        yield
+    finally:
+        await stop_app()
 
 # Create the main app without a prefix
-app = FastAPI(title="Pixel's DALL-E Image Generator API", version="1.0.0")
+app = FastAPI(title="Pixel's DALL-E Image Generator API", version="1.0.0", lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
 # Configuration
 BING_URL = "https://www.bing.com"
-STORAGE_DIR = Path("/tmp/pixel_images")
-STORAGE_DIR.mkdir(exist_ok=True)
+# Images are served by whichever worker a request lands on, so with several
+# containers STORAGE_DIR must be one volume mounted by all of them
+STORAGE_DIR = Path(os.environ.get("STORAGE_DIR", "/tmp/pixel_images"))
+STORAGE_SHARED = os.environ.get("STORAGE_SHARED", "false").lower() == "true"
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "20"))
+
+# Scale-out configuration (shared by every worker process and container)
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+REDIS_URL = os.environ.get("REDIS_URL")
+JOB_CONCURRENCY = int(os.environ.get("JOB_CONCURRENCY", "2"))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "1.0"))
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", "120"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+JOB_SHUTDOWN_TIMEOUT_SECONDS = float(os.environ.get("JOB_SHUTDOWN_TIMEOUT_SECONDS", "10"))
+LEADER_LEASE_SECONDS = int(os.environ.get("LEADER_LEASE_SECONDS", "30"))
+RATE_LIMIT_PER_MINUTE = int(os.environ.get("RATE_LIMIT_PER_MINUTE", "60"))
+DEDUP_WINDOW_SECONDS = int(os.environ.get("DEDUP_WINDOW_SECONDS", "60"))
+
+# Templated batch configuration
+MAX_TEMPLATE_PROMPTS = int(os.environ.get("MAX_TEMPLATE_PROMPTS", "100000"))
+MAX_TEMPLATE_VALUES = int(os.environ.get("MAX_TEMPLATE_VALUES", "10000"))
+MAX_TEMPLATE_COMBINATIONS = 2**63 - 1  # combination indexes are stored as MongoDB int64
+EXPAND_CHUNK_SIZE = int(os.environ.get("EXPAND_CHUNK_SIZE", "500"))
+EXPAND_LOW_WATERMARK = int(os.environ.get("EXPAND_LOW_WATERMARK", "200"))
+TEMPLATE_PLACEHOLDER = re.compile(r"\{(\w+)\}")
+
+# Storage lifecycle configuration (0 disables a limit)
+STORAGE_GC_INTERVAL_SECONDS = int(os.environ.get("STORAGE_GC_INTERVAL_SECONDS", "3600"))
+IMAGE_TTL_DAYS = float(os.environ.get("IMAGE_TTL_DAYS", "0"))
+USER_QUOTA_MB = float(os.environ.get("USER_QUOTA_MB", "0"))
+GLOBAL_QUOTA_MB = float(os.environ.get("GLOBAL_QUOTA_MB", "0"))
+ORPHAN_GRACE_SECONDS = int(os.environ.get("ORPHAN_GRACE_SECONDS", "3600"))
+STORAGE_GC_BATCH_SIZE = int(os.environ.get("STORAGE_GC_BATCH_SIZE", "1000"))
+ACCESS_TOUCH_SECONDS = 3600
+PARTIAL_SUFFIX = ".part"
+
+# Scheduling configuration
+PRIORITY_CLASSES = {"interactive": 0, "batch": 1}
+INTERACTIVE_MAX_WAIT_SECONDS = int(os.environ.get("INTERACTIVE_MAX_WAIT_SECONDS", "300"))
+ASSUMED_JOB_SECONDS = float(os.environ.get("ASSUMED_JOB_SECONDS", "90"))
+THROUGHPUT_SAMPLE_JOBS = int(os.environ.get("THROUGHPUT_SAMPLE_JOBS", "50"))
+# Optional per-caller weights, keyed by client key (first 16 hex chars of the cookie's sha256)
+FAIR_SHARE_WEIGHTS = json.loads(os.environ.get("FAIR_SHARE_WEIGHTS", "{}"))
+if any(float(weight) <= 0 for weight in FAIR_SHARE_WEIGHTS.values()):
+    raise ValueError("FAIR_SHARE_WEIGHTS values must be positive")
 
 # Available styles
 ALL_STYLES = [
@@ -63,12 +129,25 @@ class GenerationRequest(BaseModel):
     styles: Optional[List[str]] = None
     images_per_style: int = 4
     auth_cookie: Optional[str] = None
+    deadline_seconds: Optional[int] = None
 
 class BatchGenerationRequest(BaseModel):
     prompts: List[str]
     styles: Optional[List[str]] = None
     images_per_style: int = 4
     auth_cookie: Optional[str] = None
+    deadline_seconds: Optional[int] = None
+
+class TemplateBatchRequest(BaseModel):
+    template: str  # e.g. "a {animal} in {place}"
+    variables: Dict[str, List[str]]
+    styles: Optional[List[str]] = None
+    images_per_style: int = 4
+    auth_cookie: Optional[str] = None
+    deadline_seconds: Optional[int] = None
+    limit: Optional[int] = None  # expand at most this many prompts
+    sample: bool = False  # pick `limit` combinations pseudo-randomly instead of the first ones
+    seed: Optional[int] = None
 
 class GeneratedImage(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -76,8 +155,10 @@ class GeneratedImage(BaseModel):
     style: Optional[str] = None
     image_url: str
     local_path: Optional[str] = None
-    status: str = "pending"  # pending, completed, failed
+    status: str = "pending"  # pending, completed, failed, evicted
+    size_bytes: int = 0
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    last_accessed_at: datetime = Field(default_factory=datetime.utcnow)
 
 class GenerationSession(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -87,11 +168,186 @@ class GenerationSession(BaseModel):
     total_images: int
     completed_images: int = 0
     failed_images: int = 0
-    status: str = "pending"  # pending, processing, completed, failed
+    status: str = "pending"  # pending, processing, completed, failed, expired
+    owner: Optional[str] = None  # client key of the submitter, used for storage quotas
+    batch_id: Optional[str] = None  # set for sessions expanded from a templated batch
+    batch_position: Optional[int] = None  # position within that batch, for stable paging
     images: List[GeneratedImage] = []
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
+# Resilience around upstream calls: per call type retry policies with jittered
+# backoff, a circuit breaker per upstream, and optional hedged image downloads
+DEFAULT_RETRY_POLICIES = {
+    # attempts, per-try timeout and exponential backoff bounds (seconds)
+    "preload": {"attempts": 3, "timeout": 15, "backoff_base": 0.5, "backoff_max": 5},
+    # The POST starts a generation, so only resend it when it never reached Bing
+    "submit": {"attempts": 2, "timeout": 60, "backoff_base": 1, "backoff_max": 10, "retry_on": "connect"},
+    "poll": {"attempts": 1, "timeout": 30, "backoff_base": 1, "backoff_max": 5},
+    "fallback": {"attempts": 2, "timeout": 60, "backoff_base": 1, "backoff_max": 10},
+    "download": {"attempts": 3, "timeout": 30, "backoff_base": 0.5, "backoff_max": 5},
+}
+RETRY_POLICIES = {
+    call_type: {**policy, **json.loads(os.environ.get("RETRY_POLICIES", "{}")).get(call_type, {})}
+    for call_type, policy in DEFAULT_RETRY_POLICIES.items()
+}
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.environ.get("BREAKER_RESET_SECONDS", "30"))
+POLL_TIMEOUT_SECONDS = int(os.environ.get("POLL_TIMEOUT_SECONDS", "600"))
+HEDGE_DOWNLOADS = os.environ.get("HEDGE_DOWNLOADS", "false").lower() == "true"
+HEDGE_DELAY_SECONDS = float(os.environ.get("HEDGE_DELAY_SECONDS", "1.5"))
+
+# Per-process counters, exposed at /api/metrics/upstream
+UPSTREAM_METRICS: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+
+class CircuitOpenError(Exception):
+    pass
+
+class UpstreamError(Exception):
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"  # closed, open, half_open
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+
+    def available(self) -> bool:
+        if self.state == "closed":
+            return True
+        return not self.trial_in_flight and time.monotonic() - self.opened_at >= self.reset_seconds
+
+    def before_call(self) -> bool:
+        """Admit a call or raise CircuitOpenError; True when the call is the half-open trial."""
+        if self.state == "closed":
+            return False
+        if time.monotonic() - self.opened_at < self.reset_seconds or self.trial_in_flight:
+            UPSTREAM_METRICS[self.name]["breaker_rejections"] += 1
+            raise CircuitOpenError(f"Circuit for {self.name} is open")
+        # Let a single trial call through to probe whether the upstream recovered
+        self.state = "half_open"
+        self.trial_in_flight = True
+        return True
+
+    def release_trial(self):
+        # A trial that ended without an outcome (cancelled, or a non-upstream
+        # error) must not block later probes
+        self.trial_in_flight = False
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logging.warning(f"Circuit for {self.name} opened after {self.failures} failures")
+                UPSTREAM_METRICS[self.name]["breaker_opens"] += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+bing_breaker = CircuitBreaker("bing", BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS)
+cdn_breaker = CircuitBreaker("cdn", BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS)
+
+def _is_connect_failure(exc: BaseException) -> bool:
+    """True when the request failed before a connection existed, so nothing was sent."""
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    if isinstance(exc, requests.ConnectionError) and not isinstance(exc, requests.Timeout):
+        reason = getattr(exc.args[0], "reason", None) if exc.args else None
+        return isinstance(reason, ConnectTimeoutError)
+    return False
+
+def _retry_after_seconds(response: requests.Response) -> Optional[float]:
+    try:
+        return max(float(response.headers.get("Retry-After", "")), 0.0)
+    except ValueError:
+        return None
+
+def should_retry(policy: Dict[str, Any], exc: BaseException) -> bool:
+    if isinstance(exc, UpstreamError):
+        if policy.get("retry_on", "any") == "any":
+            return True
+        # A gateway 5xx does not prove the request was not acted on; only an
+        # explicit "try again after" we are willing to wait for is safe to resend
+        return (
+            exc.status_code in (429, 503)
+            and exc.retry_after is not None
+            and exc.retry_after <= policy["backoff_max"]
+        )
+    if not isinstance(exc, requests.RequestException):
+        return False
+    return policy.get("retry_on", "any") == "any" or _is_connect_failure(exc)
+
+async def resilient_call(
+    call_type: str,
+    breaker: CircuitBreaker,
+    send: Callable[[float], Awaitable[requests.Response]]
+) -> requests.Response:
+    """Run send(timeout) under the call type's retry policy and the breaker."""
+    policy = RETRY_POLICIES[call_type]
+    metrics = UPSTREAM_METRICS[call_type]
+
+    def _count_retry(retry_state):
+        metrics["retries"] += 1
+
+    backoff = wait_random_exponential(multiplier=policy["backoff_base"], max=policy["backoff_max"])
+
+    def _wait(retry_state):
+        # Never come back sooner than the upstream asked
+        retry_after = getattr(retry_state.outcome.exception(), "retry_after", None)
+        return max(backoff(retry_state), retry_after or 0)
+
+    retrying = AsyncRetrying(
+        stop=stop_after_attempt(policy["attempts"]),
+        wait=_wait,
+        retry=retry_if_exception(lambda exc: should_retry(policy, exc)),
+        before_sleep=_count_retry,
+        reraise=True
+    )
+    async for attempt in retrying:
+        with attempt:
+            is_trial = breaker.before_call()
+            metrics["calls"] += 1
+            started = time.monotonic()
+            try:
+                response = await send(policy["timeout"])
+                if response.status_code >= 500 or response.status_code == 429:
+                    raise UpstreamError(
+                        f"{call_type} returned HTTP {response.status_code}",
+                        response.status_code,
+                        _retry_after_seconds(response)
+                    )
+            except (requests.RequestException, UpstreamError):
+                metrics["failures"] += 1
+                breaker.record_failure()
+                raise
+            else:
+                breaker.record_success()
+            finally:
+                metrics["latency_seconds_total"] += time.monotonic() - started
+                if is_trial:
+                    breaker.release_trial()
+            return response
+
+_http_adapter: Optional[requests.adapters.HTTPAdapter] = None
+
+def shared_http_adapter() -> requests.adapters.HTTPAdapter:
+    global _http_adapter
+    if _http_adapter is None:
+        _http_adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+    return _http_adapter
+
 # Core Image Generator Class
 class PixelDalleGenerator:
     def __init__(self, auth_cookie: str):
@@ -112,19 +368,31 @@ class PixelDalleGenerator:
         }
         self.session.headers.update(self.headers)
         self.session.cookies.update(self._parse_cookie_string(auth_cookie))
+        # Cookies stay per generator; connections to Bing and the CDN are pooled process-wide
+        self.session.mount("https://", shared_http_adapter())
 
     def _parse_cookie_string(self, cookie_string):
         cookie = SimpleCookie()
         cookie.load(cookie_string)
         return {key: morsel.value for key, morsel in cookie.items()}
 
+    async def _request(self, call_type: str, method: str, url: str, **kwargs):
+        # requests is blocking; run it off the event loop so job leases keep heartbeating
+        async def send(timeout: float):
+            return await asyncio.to_thread(self.session.request, method, url, timeout=timeout, **kwargs)
+
+        breaker = cdn_breaker if call_type == "download" else bing_breaker
+        return await resilient_call(call_type, breaker, send)
+
     async def test_cookie(self):
         try:
-            response = self.session.get(f"{BING_URL}/images/create", timeout=30)
+            response = await self._request("preload", "GET", f"{BING_URL}/images/create")
             if response.status_code == 200 and "create" in response.url:
                 self.session.cookies.update(response.cookies)
                 return True
             return False
+        except CircuitOpenError:
+            raise
         except Exception:
             return False
 
@@ -156,6 +424,8 @@ class PixelDalleGenerator:
                         "style": style,
                         "index": i
                     })
+            except CircuitOpenError:
+                raise
             except Exception as e:
                 logging.error(f"Error generating for style '{style}': {str(e)}")
                 continue
@@ -167,7 +437,7 @@ class PixelDalleGenerator:
         payload = f"q={url_encoded_prompt}&qs=ds"
 
         # Preload to capture cookies
-        preload_response = self.session.get(f"{BING_URL}/images/create", timeout=30)
+        preload_response = await self._request("preload", "GET", f"{BING_URL}/images/create")
         if preload_response.status_code == 200:
             self.session.cookies.update(preload_response.cookies)
 
@@ -177,7 +447,7 @@ class PixelDalleGenerator:
             if rt:
                 url += f"&rt={rt}"
             
-            response = self.session.post(url, allow_redirects=False, data=payload, timeout=600)
+            response = await self._request("submit", "POST", url, allow_redirects=False, data=payload)
             
             if "this prompt has been blocked" in response.text.lower():
                 raise ValueError("Prompt blocked due to sensitive content")
@@ -185,7 +455,7 @@ class PixelDalleGenerator:
             if response.status_code == 302:
                 redirect_url = response.headers["Location"].replace("&nfy=1", "")
                 request_id = redirect_url.split("id=")[-1]
-                self.session.get(f"{BING_URL}{redirect_url}")
+                await self._request("preload", "GET", f"{BING_URL}{redirect_url}")
                 polling_url = f"{BING_URL}/images/create/async/results/{request_id}?q={url_encoded_prompt}"
                 return await self._poll_images(polling_url, images_per_style)
 
@@ -194,9 +464,9 @@ class PixelDalleGenerator:
 
     async def _poll_images(self, polling_url: str, images_per_style: int):
         start_time = time.time()
-        while time.time() - start_time < 600:  # 10 minute timeout
+        while time.time() - start_time < POLL_TIMEOUT_SECONDS:
             try:
-                response = self.session.get(polling_url, timeout=30)
+                response = await self._request("poll", "GET", polling_url)
                 if response.status_code == 200 and "errorMessage" not in response.text:
                     image_links = re.findall(r'src="([^"]+)"', response.text)
                     links = [link.split("?w=")[0] for link in image_links if "?w=" in link]
@@ -204,13 +474,15 @@ class PixelDalleGenerator:
                     if links:
                         return links[:images_per_style]
                 await asyncio.sleep(1)
+            except CircuitOpenError:
+                raise
             except Exception:
                 await asyncio.sleep(2)
-        raise TimeoutError("Request timed out after 10 minutes")
+        raise TimeoutError(f"Request timed out after {POLL_TIMEOUT_SECONDS} seconds")
 
     async def _fallback_get_images(self, url_encoded_prompt: str, images_per_style: int):
-        response = self.session.get(
-            f"{BING_URL}/images/create?q={url_encoded_prompt}&FORM=GENCRE", timeout=600
+        response = await self._request(
+            "fallback", "GET", f"{BING_URL}/images/create?q={url_encoded_prompt}&FORM=GENCRE"
         )
         
         image_links = re.findall(r'src="([^"]+)"', response.text)
@@ -223,16 +495,369 @@ class PixelDalleGenerator:
         
         raise ValueError("No images found in response")
 
+    async def _hedged_get(self, url: str, timeout: float) -> requests.Response:
+        """GET url, sending a duplicate request if the first is slower than HEDGE_DELAY_SECONDS."""
+        primary = asyncio.create_task(asyncio.to_thread(self.session.get, url, timeout=timeout))
+        done, _ = await asyncio.wait({primary}, timeout=HEDGE_DELAY_SECONDS)
+        if done:
+            return primary.result()
+
+        UPSTREAM_METRICS["download"]["hedges"] += 1
+        # The hedge uses its own connection; sharing the Session across threads is unsafe
+        hedge = asyncio.create_task(asyncio.to_thread(
+            requests.get, url, headers=dict(self.session.headers),
+            cookies=self.session.cookies.get_dict(), timeout=timeout
+        ))
+        pending = {primary, hedge}
+        outcome = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result().status_code < 500:
+                    # The loser's thread finishes in the background and its result is dropped
+                    for other in pending:
+                        other.cancel()
+                    if task is hedge:
+                        UPSTREAM_METRICS["download"]["hedge_wins"] += 1
+                    return task.result()
+                outcome = task
+        return outcome.result()
+
     async def download_image(self, url: str, filepath: str):
         try:
-            response = self.session.get(url, timeout=30)
+            if HEDGE_DOWNLOADS:
+                response = await resilient_call("download", cdn_breaker, lambda timeout: self._hedged_get(url, timeout))
+            else:
+                response = await self._request("download", "GET", url)
             if response.status_code == 200:
-                async with aiofiles.open(filepath, "wb") as f:
+                # Write beside the target and rename, so a crash never leaves a truncated PNG
+                partial_path = f"{filepath}{PARTIAL_SUFFIX}"
+                async with aiofiles.open(partial_path, "wb") as f:
                     await f.write(response.content)
+                os.replace(partial_path, filepath)
                 return True
         except Exception as e:
             logging.error(f"Failed to download image: {str(e)}")
+            if os.path.exists(f"{filepath}{PARTIAL_SUFFIX}"):
+                os.remove(f"{filepath}{PARTIAL_SUFFIX}")
+        return False
+
+# Shared coordination across worker processes and containers
+class MongoCoordination:
+    """Rate-limit counters, dedup keys and leader leases stored in MongoDB."""
+
+    def __init__(self, database):
+        self.collection = database.coordination
+
+    async def setup(self):
+        # Expired entries are reaped by MongoDB; reads still check expires_at
+        # because the TTL monitor only runs about once a minute.
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def incr_window(self, key: str, window_seconds: int) -> int:
+        bucket = int(time.time() // window_seconds)
+        update = {
+            "$inc": {"count": 1},
+            "$setOnInsert": {"expires_at": datetime.utcnow() + timedelta(seconds=window_seconds * 2)},
+        }
+        for _ in range(2):
+            try:
+                doc = await self.collection.find_one_and_update(
+                    {"_id": f"rate:{key}:{bucket}"}, update,
+                    upsert=True, return_document=ReturnDocument.AFTER
+                )
+                return doc["count"]
+            except DuplicateKeyError:
+                # Two workers upserted the same bucket at once; the retry increments it
+                continue
+        raise RuntimeError(f"Could not increment rate counter {key}")
+
+    async def _set_unless_held(self, key: str, fields: Dict[str, Any], ttl: int, holder: Dict[str, Any]) -> bool:
+        now = datetime.utcnow()
+        try:
+            await self.collection.find_one_and_update(
+                {"_id": key, "$or": [{"expires_at": {"$lte": now}}, holder]},
+                {"$set": {**fields, "expires_at": now + timedelta(seconds=ttl)}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            # A live entry held by someone else exists, so the upsert collided with it
+            return False
+
+    async def claim_key(self, key: str, value: str, ttl: int) -> Optional[str]:
+        """Store value under key unless a live entry exists; return that entry's value."""
+        if await self._set_unless_held(f"dedup:{key}", {"value": value}, ttl, {"value": value}):
+            return None
+        doc = await self.collection.find_one({"_id": f"dedup:{key}"})
+        return doc["value"] if doc else None
+
+    async def acquire_lease(self, name: str, owner: str, ttl: int) -> bool:
+        return await self._set_unless_held(f"lease:{name}", {"owner": owner}, ttl, {"owner": owner})
+
+    async def release_lease(self, name: str, owner: str):
+        await self.collection.delete_one({"_id": f"lease:{name}", "owner": owner})
+
+    async def get_version(self, name: str) -> int:
+        doc = await self.collection.find_one({"_id": f"version:{name}"})
+        return doc["version"] if doc else 0
+
+    async def bump_version(self, name: str) -> int:
+        for _ in range(2):
+            try:
+                doc = await self.collection.find_one_and_update(
+                    {"_id": f"version:{name}"}, {"$inc": {"version": 1}},
+                    upsert=True, return_document=ReturnDocument.AFTER
+                )
+                return doc["version"]
+            except DuplicateKeyError:
+                # First bump raced another worker's upsert; the retry increments the winner
+                continue
+        raise RuntimeError(f"Could not bump version {name}")
+
+class RedisCoordination:
+    """Same contract as MongoCoordination, backed by Redis for lower latency."""
+
+    RENEW_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) end return 0"
+    RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, url: str):
+        # Imported here so deployments without Redis never pay for it
+        import redis.asyncio as aioredis
+        self.redis = aioredis.from_url(url, decode_responses=True)
+
+    async def setup(self):
+        await self.redis.ping()
+
+    async def incr_window(self, key: str, window_seconds: int) -> int:
+        redis_key = f"pixel:rate:{key}:{int(time.time() // window_seconds)}"
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.incr(redis_key)
+            pipe.expire(redis_key, window_seconds * 2)
+            count, _ = await pipe.execute()
+        return count
+
+    async def claim_key(self, key: str, value: str, ttl: int) -> Optional[str]:
+        redis_key = f"pixel:dedup:{key}"
+        if await self.redis.set(redis_key, value, nx=True, ex=ttl):
+            return None
+        existing = await self.redis.get(redis_key)
+        return None if existing == value else existing
+
+    async def acquire_lease(self, name: str, owner: str, ttl: int) -> bool:
+        redis_key = f"pixel:lease:{name}"
+        if await self.redis.set(redis_key, owner, nx=True, ex=ttl):
+            return True
+        return bool(await self.redis.eval(self.RENEW_SCRIPT, 1, redis_key, owner, ttl))
+
+    async def release_lease(self, name: str, owner: str):
+        await self.redis.eval(self.RELEASE_SCRIPT, 1, f"pixel:lease:{name}", owner)
+
+    async def get_version(self, name: str) -> int:
+        return int(await self.redis.get(f"pixel:version:{name}") or 0)
+
+    async def bump_version(self, name: str) -> int:
+        return await self.redis.incr(f"pixel:version:{name}")
+
+coordination = None
+
+def create_coordination():
+    if REDIS_URL:
+        try:
+            return RedisCoordination(REDIS_URL)
+        except ImportError:
+            logging.warning("REDIS_URL is set but the redis package is not installed; using MongoDB")
+    return MongoCoordination(db)
+
+async def run_with_lease(name: str, ttl: int, task: Callable[[], Awaitable[Any]]) -> bool:
+    """Run task while holding lease name, renewing it every ttl/3.
+
+    Returns False without running task when another worker holds the lease, and
+    cancels task as soon as the lease can no longer be shown to be ours, so two
+    workers never run it at once however long it takes.
+    """
+    if not await coordination.acquire_lease(name, WORKER_ID, ttl):
         return False
+    held_until = time.monotonic() + ttl
+    work = asyncio.create_task(task())
+    try:
+        while True:
+            done, _ = await asyncio.wait({work}, timeout=ttl / 3)
+            if done:
+                work.result()
+                return True
+            renewed_at = time.monotonic()
+            try:
+                held = await coordination.acquire_lease(name, WORKER_ID, ttl)
+            except Exception as e:
+                logging.warning(f"Could not renew lease {name}: {str(e)}")
+                # Keep going only while the last renewal is safely unexpired
+                held = time.monotonic() < held_until - ttl / 3
+            else:
+                if held:
+                    held_until = renewed_at + ttl
+            if not held:
+                logging.warning(f"Lost lease {name}, stopping its task")
+                return True
+    finally:
+        if not work.done():
+            work.cancel()
+            await asyncio.wait({work})
+
+def client_key(auth_cookie: Optional[str], http_request: Request) -> str:
+    """Identify the caller by cookie, or by client address when using the anonymous cookie."""
+    if auth_cookie and auth_cookie.strip() not in ("", "_U="):
+        source = auth_cookie
+    else:
+        source = http_request.headers.get("x-real-ip") or (http_request.client.host if http_request.client else "unknown")
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+
+async def enforce_rate_limit(key: str):
+    if RATE_LIMIT_PER_MINUTE <= 0:
+        return
+    if await coordination.incr_window(f"generate:{key}", 60) > RATE_LIMIT_PER_MINUTE:
+        raise HTTPException(status_code=429, detail="Rate limit exceeded, try again in a minute")
+
+# Response cache for hot read endpoints: an in-process TTL/LRU layer, with
+# bodies also shared through Redis when coordination uses it. Each namespace
+# carries a version in the coordination store (MongoDB or Redis), and
+# invalidating a namespace bumps it so every worker stops serving old entries.
+# Workers re-read a version at most every CACHE_VERSION_SECONDS, so most hits
+# never leave the process; the worker that invalidates sees it immediately.
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "1024"))
+CACHE_TTL_SECONDS = float(os.environ.get("CACHE_TTL_SECONDS", "5"))
+CACHE_VERSION_SECONDS = float(os.environ.get("CACHE_VERSION_SECONDS", "1"))
+STYLES_CACHE_SECONDS = 3600
+
+class ResponseCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, Tuple[float, bytes, str]]" = OrderedDict()
+        self.inflight: Dict[str, asyncio.Future] = {}
+        # namespace -> (monotonic expiry, version last read from the coordination store)
+        self.versions: Dict[str, Tuple[float, int]] = {}
+        self.stats = {"hits": 0, "shared_hits": 0, "misses": 0, "invalidations": 0, "bypasses": 0}
+
+    @property
+    def redis(self):
+        return coordination.redis if isinstance(coordination, RedisCoordination) else None
+
+    @staticmethod
+    def _render(value: Any) -> bytes:
+        # Same rendering as FastAPI's JSONResponse
+        return json.dumps(
+            jsonable_encoder(value), ensure_ascii=False, allow_nan=False, separators=(",", ":")
+        ).encode("utf-8")
+
+    @staticmethod
+    def _etag(body: bytes) -> str:
+        return f'"{hashlib.sha1(body).hexdigest()}"'
+
+    async def _version(self, namespace: str) -> Optional[int]:
+        known = self.versions.get(namespace)
+        if known and known[0] > time.monotonic():
+            return known[1]
+        try:
+            version = await coordination.get_version(f"cache:{namespace}")
+        except Exception as e:
+            logging.warning(f"Cache version lookup for {namespace} failed, bypassing cache: {str(e)}")
+            return None
+        current = self.versions.get(namespace)
+        if current is not None and current is not known:
+            # An invalidation on this worker landed while the lookup was in flight
+            return current[1]
+        self.versions[namespace] = (time.monotonic() + CACHE_VERSION_SECONDS, version)
+        return version
+
+    async def invalidate(self, namespace: str):
+        self.stats["invalidations"] += 1
+        try:
+            version = await coordination.bump_version(f"cache:{namespace}")
+        except Exception as e:
+            logging.warning(f"Cache invalidation of {namespace} failed: {str(e)}")
+            self.versions.pop(namespace, None)
+            return
+        self.versions[namespace] = (time.monotonic() + CACHE_VERSION_SECONDS, version)
+
+    async def fetch(self, namespace: str, key: str, ttl: float, produce: Callable[[], Awaitable[Any]]) -> Tuple[bytes, str]:
+        """Return (body, etag) for a key, producing and storing it on a miss."""
+        while True:
+            version = await self._version(namespace)
+            if version is None:
+                # Without a trustworthy version a cached body could be stale on this worker
+                self.stats["bypasses"] += 1
+                body = self._render(await produce())
+                return body, self._etag(body)
+            full_key = f"{namespace}:{version}:{key}"
+            entry = self.entries.get(full_key)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(full_key)
+                self.stats["hits"] += 1
+                return entry[1], entry[2]
+            pending = self.inflight.get(full_key)
+            if pending is None:
+                break
+            # Another request is already producing this entry; share its result.
+            # asyncio.wait never cancels pending, even if this request is cancelled.
+            await asyncio.wait({pending})
+            if not pending.cancelled():
+                return pending.result()
+            # The producing request was cancelled; look again and produce it here if needed
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.inflight[full_key] = future
+        try:
+            body = None
+            if self.redis is not None:
+                shared = await self.redis.get(f"pixel:cache:{full_key}")
+                if shared is not None:
+                    self.stats["shared_hits"] += 1
+                    body = shared.encode("utf-8")
+            if body is None:
+                self.stats["misses"] += 1
+                body = self._render(await produce())
+                if self.redis is not None:
+                    await self.redis.set(f"pixel:cache:{full_key}", body.decode("utf-8"), ex=max(1, math.ceil(ttl)))
+            etag = self._etag(body)
+            self.entries[full_key] = (time.monotonic() + ttl, body, etag)
+            self.entries.move_to_end(full_key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            future.set_result((body, etag))
+            return body, etag
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            # Cancellation skips both branches above; release waiters so they retry
+            if not future.done():
+                future.cancel()
+            del self.inflight[full_key]
+
+response_cache = ResponseCache(CACHE_MAX_ENTRIES)
+
+async def cached_response(
+    http_request: Request,
+    namespace: str,
+    key: str,
+    produce: Callable[[], Awaitable[Any]],
+    ttl: float = CACHE_TTL_SECONDS,
+    cache_control: str = "private, no-cache"
+) -> Response:
+    body, etag = await response_cache.fetch(namespace, key, ttl, produce)
+    return etag_response(http_request, body, etag, cache_control)
+
+def etag_response(http_request: Request, body: bytes, etag: str, cache_control: str) -> Response:
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if http_request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# The style list never changes while the process runs, so it is rendered once
+# and served without touching the cache versions or the database
+STYLES_BODY = ResponseCache._render({"styles": ALL_STYLES})
+STYLES_ETAG = ResponseCache._etag(STYLES_BODY)
 
 # API Routes
 @api_router.get("/")
@@ -240,8 +865,8 @@ async def root():
     return {"message": "Pixel's DALL-E Image Generator API v1.0.0"}
 
 @api_router.get("/styles")
-async def get_styles():
-    return {"styles": ALL_STYLES}
+async def get_styles(http_request: Request):
+    return etag_response(http_request, STYLES_BODY, STYLES_ETAG, f"public, max-age={STYLES_CACHE_SECONDS}")
 
 @api_router.post("/settings")
 async def save_settings(settings: UserSettings):
@@ -251,19 +876,23 @@ async def save_settings(settings: UserSettings):
         settings.dict(), 
         upsert=True
     )
+    await response_cache.invalidate(f"settings:{settings.id}")
     return settings
 
 @api_router.get("/settings/{user_id}")
-async def get_settings(user_id: str):
-    settings = await db.user_settings.find_one({"id": user_id})
-    if not settings:
-        # Return default settings
-        default_settings = UserSettings(id=user_id)
-        return default_settings
-    return UserSettings(**settings)
+async def get_settings(user_id: str, http_request: Request):
+    async def produce():
+        settings = await db.user_settings.find_one({"id": user_id})
+        if not settings:
+            # Return default settings
+            default_settings = UserSettings(id=user_id)
+            return default_settings
+        return UserSettings(**settings)
+
+    return await cached_response(http_request, f"settings:{user_id}", "settings", produce)
 
 @api_router.post("/generate")
-async def generate_images(request: GenerationRequest, background_tasks: BackgroundTasks):
+async def generate_images(request: GenerationRequest, http_request: Request):
     # Validate request
     if not request.prompt.strip():
         raise HTTPException(status_code=400, detail="Prompt cannot be empty")
@@ -271,69 +900,185 @@ async def generate_images(request: GenerationRequest, background_tasks: Backgrou
     if request.images_per_style > 4:
         raise HTTPException(status_code=400, detail="Images per style cannot exceed 4")
 
+    auth_cookie = request.auth_cookie or "_U="
+    caller = client_key(auth_cookie, http_request)
+    await enforce_rate_limit(caller)
+    if not bing_breaker.available():
+        raise HTTPException(
+            status_code=503,
+            detail="Image service is temporarily unavailable",
+            headers={"Retry-After": str(int(BREAKER_RESET_SECONDS))}
+        )
+    cost = job_cost(request.styles, request.images_per_style)
+    estimated_wait = await admit(caller, "interactive", cost, request.deadline_seconds)
+
     # Create generation session
     session = GenerationSession(
         prompt=request.prompt,
+        owner=caller,
         styles=request.styles or [],
         images_per_style=request.images_per_style,
         total_images=len(request.styles or [None]) * request.images_per_style
     )
+
+    # Identical submissions from the same caller (double clicks, client retries
+    # hitting another worker) collapse onto the first session
+    if DEDUP_WINDOW_SECONDS > 0:
+        fingerprint = hashlib.sha256(
+            json.dumps([caller, request.prompt, session.styles, session.images_per_style]).encode("utf-8")
+        ).hexdigest()
+        existing_id = await coordination.claim_key(fingerprint, session.id, DEDUP_WINDOW_SECONDS)
+        if existing_id:
+            return {
+                "session_id": existing_id,
+                "status": "processing",
+                "total_images": session.total_images,
+                "deduplicated": True
+            }
     
     # Save session to database
     await db.generation_sessions.insert_one(session.dict())
+    await response_cache.invalidate("sessions")
     
-    # Start background generation
-    background_tasks.add_task(
-        process_generation,
-        session.id,
-        request.prompt,
-        request.styles or [],
-        request.images_per_style,
-        request.auth_cookie or "_U="
+    # Queue generation for whichever worker claims it first
+    tags = await assign_fair_share_tags(caller, "interactive", [cost])
+    await db.generation_jobs.insert_one(
+        new_job(session, auth_cookie, caller, "interactive", tags[0], deadline_from_now(request.deadline_seconds))
     )
     
     return {
         "session_id": session.id,
         "status": "processing",
-        "total_images": session.total_images
+        "total_images": session.total_images,
+        "estimated_wait_seconds": int(estimated_wait)
     }
 
 @api_router.post("/generate-batch")
-async def generate_batch(request: BatchGenerationRequest, background_tasks: BackgroundTasks):
+async def generate_batch(request: BatchGenerationRequest, http_request: Request):
     if not request.prompts:
         raise HTTPException(status_code=400, detail="No prompts provided")
+
+    auth_cookie = request.auth_cookie or "_U="
+    caller = client_key(auth_cookie, http_request)
+    await enforce_rate_limit(caller)
+    cost = job_cost(request.styles, request.images_per_style)
     
     sessions = []
     for prompt in request.prompts:
         if prompt.strip():
             session = GenerationSession(
                 prompt=prompt,
+                owner=caller,
                 styles=request.styles or [],
                 images_per_style=request.images_per_style,
                 total_images=len(request.styles or [None]) * request.images_per_style
             )
             sessions.append(session)
+
+    estimated_wait = await admit(caller, "batch", cost, request.deadline_seconds, count=len(sessions))
     
     # Save all sessions
     if sessions:
         await db.generation_sessions.insert_many([s.dict() for s in sessions])
+        await response_cache.invalidate("sessions")
         
-        # Start background processing for each
-        for session in sessions:
-            background_tasks.add_task(
-                process_generation,
-                session.id,
-                session.prompt,
-                session.styles,
-                session.images_per_style,
-                request.auth_cookie or "_U="
-            )
+        # Queue processing for each, behind interactive work and interleaved with other callers
+        tags = await assign_fair_share_tags(caller, "batch", [cost] * len(sessions))
+        expires = deadline_from_now(request.deadline_seconds)
+        await db.generation_jobs.insert_many([
+            new_job(s, auth_cookie, caller, "batch", tag, expires) for s, tag in zip(sessions, tags)
+        ])
     
     return {
         "batch_id": str(uuid.uuid4()),
         "sessions": [{"session_id": s.id, "prompt": s.prompt} for s in sessions],
-        "total_sessions": len(sessions)
+        "total_sessions": len(sessions),
+        "estimated_wait_seconds": int(estimated_wait)
+    }
+
+@api_router.post("/generate-template")
+async def generate_template_batch(request: TemplateBatchRequest, http_request: Request):
+    names = list(dict.fromkeys(TEMPLATE_PLACEHOLDER.findall(request.template)))
+    if not request.template.strip():
+        raise HTTPException(status_code=400, detail="Template cannot be empty")
+    if request.images_per_style > 4:
+        raise HTTPException(status_code=400, detail="Images per style cannot exceed 4")
+    missing = [name for name in names if not request.variables.get(name)]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"No values for template variables: {', '.join(missing)}")
+    variables = {name: request.variables[name] for name in names}
+    if sum(len(values) for values in variables.values()) > MAX_TEMPLATE_VALUES:
+        raise HTTPException(status_code=400, detail=f"Templates accept at most {MAX_TEMPLATE_VALUES} variable values")
+
+    if request.limit is not None and request.limit < 1:
+        raise HTTPException(status_code=400, detail="Limit must be at least 1")
+
+    combinations = math.prod(len(values) for values in variables.values())
+    if combinations > MAX_TEMPLATE_COMBINATIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Template has too many combinations; at most {MAX_TEMPLATE_COMBINATIONS} are supported"
+        )
+    total = min(combinations, request.limit) if request.limit else combinations
+    if total > MAX_TEMPLATE_PROMPTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Template expands to {combinations} prompts; set a limit of at most {MAX_TEMPLATE_PROMPTS}"
+        )
+
+    auth_cookie = request.auth_cookie or "_U="
+    caller = client_key(auth_cookie, http_request)
+    await enforce_rate_limit(caller)
+    estimated_wait = await admit(
+        caller, "batch", job_cost(request.styles, request.images_per_style), request.deadline_seconds, count=total
+    )
+
+    stride, offset = template_permutation(combinations, request.sample, request.seed)
+    batch = {
+        "id": str(uuid.uuid4()),
+        "template": request.template,
+        "variables": variables,
+        "styles": request.styles or [],
+        "images_per_style": request.images_per_style,
+        "auth_cookie": auth_cookie,
+        "client_key": caller,
+        "combinations": combinations,
+        "total": total,
+        "stride": stride,
+        "offset": offset,
+        "expanded": 0,
+        "deadline_at": deadline_from_now(request.deadline_seconds),
+        "status": "expanding",  # expanding, expanded, expired
+        "created_at": datetime.utcnow()
     }
+    await db.template_batches.insert_one(batch)
+
+    return {
+        "batch_id": batch["id"],
+        "total_sessions": total,
+        "status": batch["status"],
+        "estimated_wait_seconds": int(estimated_wait)
+    }
+
+@api_router.get("/template-batch/{batch_id}")
+async def get_template_batch(batch_id: str):
+    batch = await db.template_batches.find_one({"id": batch_id}, {"_id": 0, "auth_cookie": 0})
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    counts = await db.generation_sessions.aggregate([
+        {"$match": {"batch_id": batch_id}},
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ]).to_list(None)
+    batch["sessions_by_status"] = {entry["_id"]: entry["count"] for entry in counts}
+    return batch
+
+@api_router.get("/template-batch/{batch_id}/sessions")
+async def get_template_batch_sessions(batch_id: str, skip: int = 0, limit: int = 50):
+    # A chunk creates many sessions within the same millisecond, so page by batch position
+    sessions = await db.generation_sessions.find({"batch_id": batch_id}).sort(
+        [("batch_position", 1), ("id", 1)]
+    ).skip(skip).limit(limit).to_list(limit)
+    return [GenerationSession(**session) for session in sessions]
 
 @api_router.get("/session/{session_id}")
 async def get_session(session_id: str):
@@ -343,9 +1088,90 @@ async def get_session(session_id: str):
     return GenerationSession(**session)
 
 @api_router.get("/sessions")
-async def get_sessions(limit: int = 50):
-    sessions = await db.generation_sessions.find().sort("created_at", -1).limit(limit).to_list(limit)
-    return [GenerationSession(**session) for session in sessions]
+async def get_sessions(http_request: Request, limit: int = 50):
+    async def produce():
+        sessions = await db.generation_sessions.find().sort("created_at", -1).limit(limit).to_list(limit)
+        return [GenerationSession(**session) for session in sessions]
+
+    return await cached_response(http_request, "sessions", str(limit), produce)
+
+# Streaming export for analytics: NDJSON straight off a MongoDB cursor so memory
+# stays flat however many sessions are exported
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "500"))
+EXPORT_CHUNK_BYTES = 64 * 1024
+# updated_at is stamped by many workers' clocks and a write can commit after
+# its timestamp; sessions newer than this lag are left for the next export
+EXPORT_SAFETY_LAG_SECONDS = int(os.environ.get("EXPORT_SAFETY_LAG_SECONDS", "60"))
+
+def _export_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+async def _export_records(since: Optional[datetime], since_id: Optional[str], include_images: bool):
+    until = datetime.utcnow() - timedelta(seconds=EXPORT_SAFETY_LAG_SECONDS)
+    query: Dict[str, Any] = {"updated_at": {"$lte": until}}
+    if since:
+        # (updated_at, id) is the watermark, so sessions sharing a timestamp are not skipped
+        query = {"$and": [query, {"$or": [
+            {"updated_at": {"$gt": since}},
+            {"updated_at": since, "id": {"$gt": since_id or ""}}
+        ]}]}
+    projection = {"_id": 0} if include_images else {"_id": 0, "images": 0}
+    cursor = db.generation_sessions.find(query, projection).sort(
+        [("updated_at", 1), ("id", 1)]
+    ).batch_size(EXPORT_BATCH_SIZE)
+
+    watermark = {"updated_at": since, "id": since_id}
+    count = 0
+    async for session in cursor:
+        images = session.pop("images", [])
+        yield {"type": "session", **session}
+        for image in images:
+            yield {"type": "image", "session_id": session["id"], **image}
+        watermark = {"updated_at": session["updated_at"], "id": session["id"]}
+        count += 1
+    # Pass these back as since/since_id to fetch only what changed afterwards;
+    # the watermark never passes `until`, so late commits are picked up next time
+    yield {
+        "type": "watermark",
+        "sessions": count,
+        "since": watermark["updated_at"],
+        "since_id": watermark["id"],
+        "until": until
+    }
+
+async def _export_stream(records, compress: bool):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+    buffer = []
+    size = 0
+    async for record in records:
+        line = json.dumps(record, default=_export_default).encode("utf-8") + b"\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            chunk = b"".join(buffer)
+            buffer, size = [], 0
+            yield compressor.compress(chunk) if compressor else chunk
+    chunk = b"".join(buffer)
+    if compressor:
+        yield compressor.compress(chunk) + compressor.flush()
+    elif chunk:
+        yield chunk
+
+@api_router.get("/export/sessions")
+async def export_sessions(
+    since: Optional[datetime] = None,
+    since_id: Optional[str] = None,
+    include_images: bool = True,
+    gzip: bool = False
+):
+    filename = f"sessions_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.ndjson"
+    return StreamingResponse(
+        _export_stream(_export_records(since, since_id, include_images), gzip),
+        media_type="application/gzip" if gzip else "application/x-ndjson",
+        headers={"Content-Disposition": f"attachment; filename={filename}{'.gz' if gzip else ''}"}
+    )
 
 @api_router.get("/image/{image_id}")
 async def get_image(image_id: str):
@@ -356,7 +1182,8 @@ async def get_image(image_id: str):
     # Find the specific image
     for image in session["images"]:
         if image["id"] == image_id:
-            if image.get("local_path") and os.path.exists(image["local_path"]):
+            if image.get("status") != "evicted" and image.get("local_path") and os.path.exists(image["local_path"]):
+                await touch_image(session["id"], image)
                 return FileResponse(
                     image["local_path"],
                     media_type="image/png",
@@ -384,9 +1211,67 @@ async def upload_prompts(file: UploadFile = File(...)):
 async def test_cookie(cookie_data: dict):
     auth_cookie = cookie_data.get("cookie", "_U=")
     generator = PixelDalleGenerator(auth_cookie)
-    is_valid = await generator.test_cookie()
+    try:
+        is_valid = await generator.test_cookie()
+    except CircuitOpenError:
+        raise HTTPException(
+            status_code=503,
+            detail="Image service is temporarily unavailable",
+            headers={"Retry-After": str(int(BREAKER_RESET_SECONDS))}
+        )
     return {"valid": is_valid}
 
+@api_router.get("/health/live")
+async def liveness():
+    return {"status": "alive", "worker_id": WORKER_ID}
+
+@api_router.get("/health/ready")
+async def readiness():
+    checks = {"mongo": False, "indexes": app_state["indexes_ready"]}
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), timeout=2)
+        checks["mongo"] = True
+    except Exception:
+        pass
+    if not checks["mongo"] or not checks["indexes"]:
+        raise HTTPException(status_code=503, detail=checks)
+    return {"status": "ready", "worker_id": WORKER_ID, **checks}
+
+@api_router.get("/metrics/upstream")
+async def get_upstream_metrics():
+    return {
+        "worker_id": WORKER_ID,
+        "breakers": {
+            breaker.name: {"state": breaker.state, "failures": breaker.failures}
+            for breaker in (bing_breaker, cdn_breaker)
+        },
+        "calls": UPSTREAM_METRICS,
+        "retry_policies": RETRY_POLICIES,
+        "response_cache": {**response_cache.stats, "entries": len(response_cache.entries)}
+    }
+
+@api_router.get("/storage/report")
+async def get_storage_report():
+    usage = await db.generation_sessions.aggregate([
+        {"$match": {"images.status": "completed"}},
+        {"$unwind": "$images"},
+        {"$match": {"images.status": "completed"}},
+        {"$group": {"_id": None, "images": {"$sum": 1}, "bytes": {"$sum": "$images.size_bytes"}}}
+    ], allowDiskUse=True).to_list(1)
+    reports = await db.storage_reports.find({}, {"_id": 0}).sort("finished_at", -1).to_list(100)
+    return {
+        "usage": {
+            "images": usage[0]["images"] if usage else 0,
+            "bytes": usage[0]["bytes"] if usage else 0
+        },
+        "limits": {
+            "image_ttl_days": IMAGE_TTL_DAYS,
+            "user_quota_mb": USER_QUOTA_MB,
+            "global_quota_mb": GLOBAL_QUOTA_MB
+        },
+        "reports": reports
+    }
+
 # Background task for processing generation
 async def process_generation(session_id: str, prompt: str, styles: List[str], images_per_style: int, auth_cookie: str):
     try:
@@ -395,6 +1280,7 @@ async def process_generation(session_id: str, prompt: str, styles: List[str], im
             {"id": session_id},
             {"$set": {"status": "processing", "updated_at": datetime.utcnow()}}
         )
+        await response_cache.invalidate("sessions")
         
         generator = PixelDalleGenerator(auth_cookie)
         
@@ -415,7 +1301,8 @@ async def process_generation(session_id: str, prompt: str, styles: List[str], im
             image_id = str(uuid.uuid4())
             timestamp = time.strftime("%Y%m%d_%H%M%S")
             style_part = f"_{link_data['style'].replace(' ', '_')}" if link_data['style'] else ""
-            filename = f"pixel_image{style_part}_{timestamp}_{link_data['index']}.png"
+            # The id suffix keeps sessions finishing in the same second from sharing a file
+            filename = f"pixel_image{style_part}_{timestamp}_{link_data['index']}_{image_id[:8]}.png"
             filepath = STORAGE_DIR / filename
             
             # Create image record
@@ -431,6 +1318,7 @@ async def process_generation(session_id: str, prompt: str, styles: List[str], im
             # Download image
             if await generator.download_image(link_data['url'], str(filepath)):
                 image.status = "completed"
+                image.size_bytes = os.path.getsize(filepath)
             else:
                 image.status = "failed"
             
@@ -453,12 +1341,627 @@ async def process_generation(session_id: str, prompt: str, styles: List[str], im
             }
         )
         
+    except CircuitOpenError:
+        # Bing is degraded: hand the session back to the queue instead of failing it
+        await db.generation_sessions.update_one(
+            {"id": session_id},
+            {"$set": {"status": "pending", "updated_at": datetime.utcnow()}}
+        )
+        raise
     except Exception as e:
         logging.error(f"Generation failed for session {session_id}: {str(e)}")
         await db.generation_sessions.update_one(
             {"id": session_id},
             {"$set": {"status": "failed", "updated_at": datetime.utcnow()}}
         )
+    finally:
+        # Every exit path above has just rewritten the session
+        await response_cache.invalidate("sessions")
+
+# Scheduler: strict priority between classes, weighted fair queuing between
+# callers inside a class, and admission control against the estimated wait
+def job_cost(styles: List[str], images_per_style: int) -> int:
+    return len(styles or [None]) * images_per_style
+
+def fair_share_weight(caller: str) -> float:
+    return float(FAIR_SHARE_WEIGHTS.get(caller, 1.0))
+
+async def _fair_share_start(caller: str, priority_class: str) -> float:
+    clock = await db.scheduler_state.find_one({"_id": f"vtime:{priority_class}"})
+    state = await db.scheduler_state.find_one({"_id": f"client:{priority_class}:{caller}"})
+    return max(clock["vtime"] if clock else 0.0, state["finish"] if state else 0.0)
+
+async def assign_fair_share_tags(caller: str, priority_class: str, costs: List[int]) -> List[Tuple[float, float]]:
+    """Reserve consecutive (start, finish) virtual tags for a caller's jobs."""
+    weight = fair_share_weight(caller)
+    total = sum(costs) / weight
+    clock = await db.scheduler_state.find_one({"_id": f"vtime:{priority_class}"})
+    vtime = clock["vtime"] if clock else 0.0
+    # Pipeline update so concurrent submissions from one caller never share tags
+    state = await db.scheduler_state.find_one_and_update(
+        {"_id": f"client:{priority_class}:{caller}"},
+        [{"$set": {
+            "finish": {"$add": [{"$max": [{"$ifNull": ["$finish", 0]}, vtime]}, total]},
+            "expires_at": datetime.utcnow() + timedelta(days=1)
+        }}],
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    start = state["finish"] - total
+    tags = []
+    for cost in costs:
+        finish = start + cost / weight
+        tags.append((start, finish))
+        start = finish
+    return tags
+
+async def register_worker():
+    """Advertise this worker's job slots; admission sizes the cluster from the live ones."""
+    await db.scheduler_state.update_one(
+        {"_id": f"worker:{WORKER_ID}"},
+        {"$set": {
+            "slots": JOB_CONCURRENCY,
+            "expires_at": datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS)
+        }},
+        upsert=True
+    )
+
+async def worker_presence_loop():
+    while True:
+        try:
+            await register_worker()
+        except Exception as e:
+            logging.error(f"Worker registration failed: {str(e)}")
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+
+_throughput_cache = {"at": float("-inf"), "value": 0.0}
+
+async def recent_throughput() -> float:
+    """Cluster-wide jobs per second: live job slots over the recent mean job duration, cached briefly per process."""
+    if time.monotonic() - _throughput_cache["at"] > 10:
+        workers = await db.scheduler_state.find(
+            {"_id": {"$regex": "^worker:"}, "expires_at": {"$gt": datetime.utcnow()}}, {"slots": 1}
+        ).to_list(None)
+        slots = sum(worker.get("slots", 0) for worker in workers) or JOB_CONCURRENCY
+        # Durations of the latest jobs, not completions per minute, so idle periods do not lower the estimate
+        recent = await db.generation_jobs.aggregate([
+            {"$match": {"status": "done", "finished_at": {"$ne": None}}},
+            {"$sort": {"finished_at": -1}},
+            {"$limit": THROUGHPUT_SAMPLE_JOBS},
+            {"$group": {"_id": None, "ms": {"$avg": {"$subtract": ["$finished_at", "$started_at"]}}}}
+        ]).to_list(1)
+        job_seconds = recent[0]["ms"] / 1000 if recent and recent[0]["ms"] else ASSUMED_JOB_SECONDS
+        _throughput_cache["value"] = slots / max(job_seconds, 1.0)
+        _throughput_cache["at"] = time.monotonic()
+    return _throughput_cache["value"]
+
+async def admit(
+    caller: str,
+    priority_class: str,
+    cost: int,
+    deadline_seconds: Optional[int],
+    count: int = 1
+) -> float:
+    """Estimate when the last of count new jobs would start and reject the work if that misses its deadline."""
+    if deadline_seconds is not None and deadline_seconds <= 0:
+        raise HTTPException(status_code=400, detail="deadline_seconds must be positive")
+    priority = PRIORITY_CLASSES[priority_class]
+    count = max(count, 1)
+    # Finish tag of the last job, so a large batch is judged by its tail rather than its head
+    virtual_finish = await _fair_share_start(caller, priority_class) + cost * count / fair_share_weight(caller)
+    ahead = await db.generation_jobs.count_documents({
+        "status": "queued",
+        "$or": [
+            {"priority": {"$lt": priority}},
+            {"priority": priority, "virtual_finish": {"$lt": virtual_finish}}
+        ]
+    })
+    wait = (ahead + count - 1) / await recent_throughput()
+    limit = deadline_seconds or (INTERACTIVE_MAX_WAIT_SECONDS if priority_class == "interactive" else None)
+    if limit and wait > limit:
+        raise HTTPException(
+            status_code=503,
+            detail=f"Estimated wait of {int(wait)}s exceeds the {limit}s deadline",
+            headers={"Retry-After": str(int(wait - limit) + 1)}
+        )
+    return wait
+
+def deadline_from_now(deadline_seconds: Optional[int]) -> Optional[datetime]:
+    return datetime.utcnow() + timedelta(seconds=deadline_seconds) if deadline_seconds else None
+
+async def expire_overdue_jobs():
+    """Fail queued jobs whose caller-supplied deadline has already passed."""
+    now = datetime.utcnow()
+    overdue = await db.generation_jobs.find(
+        {"status": "queued", "deadline_at": {"$lte": now}}, {"id": 1, "session_id": 1}
+    ).to_list(None)
+    if not overdue:
+        return
+    await db.generation_jobs.update_many(
+        {"id": {"$in": [j["id"] for j in overdue]}, "status": "queued"},
+        {"$set": {"status": "failed", "finished_at": now}, "$unset": {"auth_cookie": ""}}
+    )
+    await db.generation_sessions.update_many(
+        {"id": {"$in": [j["session_id"] for j in overdue]}},
+        {"$set": {"status": "expired", "updated_at": now}}
+    )
+    logging.warning(f"Expired {len(overdue)} jobs past their deadline")
+
+# Durable job queue: every worker claims from MongoDB, so jobs survive restarts
+# and are never processed by two workers at once
+def new_job(
+    session: GenerationSession,
+    auth_cookie: str,
+    caller: str,
+    priority_class: str,
+    tags: Tuple[float, float],
+    deadline_at: Optional[datetime] = None,
+    job_id: Optional[str] = None
+) -> Dict[str, Any]:
+    return {
+        "id": job_id or str(uuid.uuid4()),
+        "session_id": session.id,
+        "prompt": session.prompt,
+        "styles": session.styles,
+        "images_per_style": session.images_per_style,
+        "auth_cookie": auth_cookie,
+        "client_key": caller,
+        "batch_id": session.batch_id,
+        "priority_class": priority_class,
+        "priority": PRIORITY_CLASSES[priority_class],
+        "virtual_start": tags[0],
+        "virtual_finish": tags[1],
+        "deadline_at": deadline_at,
+        "status": "queued",  # queued, running, done, failed
+        "attempts": 0,
+        "worker_id": None,
+        "lease_expires_at": None,
+        "created_at": datetime.utcnow()
+    }
+
+async def claim_next_job() -> Optional[Dict[str, Any]]:
+    now = datetime.utcnow()
+    job = await db.generation_jobs.find_one_and_update(
+        {"status": "queued", "$or": [{"deadline_at": None}, {"deadline_at": {"$gt": now}}]},
+        {
+            "$set": {
+                "status": "running",
+                "worker_id": WORKER_ID,
+                "started_at": now,
+                "lease_expires_at": now + timedelta(seconds=JOB_LEASE_SECONDS)
+            },
+            "$inc": {"attempts": 1}
+        },
+        # Strict priority between classes, then smallest fair-share finish tag
+        sort=[("priority", 1), ("virtual_finish", 1), ("created_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+    if job:
+        # Advance the class's virtual clock to the start tag of the job entering service
+        await db.scheduler_state.update_one(
+            {"_id": f"vtime:{job['priority_class']}"},
+            {"$max": {"vtime": job["virtual_start"]}},
+            upsert=True
+        )
+    return job
+
+async def _heartbeat_job(job_id: str):
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            await db.generation_jobs.update_one(
+                {"id": job_id, "worker_id": WORKER_ID},
+                {"$set": {"lease_expires_at": datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS)}}
+            )
+        except Exception as e:
+            # Keep trying: losing the lease would hand the job to a second worker
+            logging.error(f"Heartbeat for job {job_id} failed: {str(e)}")
+
+async def run_job(job: Dict[str, Any]):
+    heartbeat = asyncio.create_task(_heartbeat_job(job["id"]))
+    try:
+        await process_generation(
+            job["session_id"],
+            job["prompt"],
+            job["styles"],
+            job["images_per_style"],
+            job["auth_cookie"]
+        )
+    except CircuitOpenError:
+        # Not the job's fault, so the attempt is not counted against it
+        await db.generation_jobs.update_one(
+            {"id": job["id"], "worker_id": WORKER_ID},
+            {
+                "$set": {"status": "queued", "worker_id": None, "lease_expires_at": None},
+                "$inc": {"attempts": -1}
+            }
+        )
+        return
+    finally:
+        heartbeat.cancel()
+    await db.generation_jobs.update_one(
+        {"id": job["id"], "worker_id": WORKER_ID},
+        {
+            "$set": {"status": "done", "finished_at": datetime.utcnow()},
+            "$unset": {"auth_cookie": "", "lease_expires_at": ""}
+        }
+    )
+
+async def job_worker_loop():
+    slots = asyncio.Semaphore(JOB_CONCURRENCY)
+    while True:
+        await slots.acquire()
+        if not bing_breaker.available():
+            # Leave work in the queue for healthier workers until the breaker half-opens
+            slots.release()
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            continue
+        try:
+            job = await claim_next_job()
+        except Exception as e:
+            logging.error(f"Failed to claim job: {str(e)}")
+            job = None
+        if not job:
+            slots.release()
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            continue
+
+        async def _run(claimed=job):
+            try:
+                await run_job(claimed)
+            except Exception as e:
+                logging.error(f"Job {claimed['id']} crashed: {str(e)}")
+            finally:
+                running_jobs.pop(asyncio.current_task(), None)
+                slots.release()
+
+        running_jobs[asyncio.create_task(_run())] = job["id"]
+
+async def requeue_stale_jobs():
+    """Return jobs whose worker stopped heartbeating to the queue, or fail them."""
+    now = datetime.utcnow()
+    stale = {"status": "running", "lease_expires_at": {"$lt": now}}
+    exhausted = await db.generation_jobs.find(
+        {**stale, "attempts": {"$gte": JOB_MAX_ATTEMPTS}}, {"id": 1, "session_id": 1}
+    ).to_list(None)
+    if exhausted:
+        await db.generation_jobs.update_many(
+            {"id": {"$in": [j["id"] for j in exhausted]}},
+            {"$set": {"status": "failed", "finished_at": now}, "$unset": {"auth_cookie": ""}}
+        )
+        await db.generation_sessions.update_many(
+            {"id": {"$in": [j["session_id"] for j in exhausted]}},
+            {"$set": {"status": "failed", "updated_at": now}}
+        )
+    result = await db.generation_jobs.update_many(
+        stale, {"$set": {"status": "queued", "worker_id": None, "lease_expires_at": None}}
+    )
+    if result.modified_count or exhausted:
+        logging.warning(f"Requeued {result.modified_count} stale jobs, failed {len(exhausted)}")
+
+# Storage lifecycle: TTL and quota eviction are decided from the database on the
+# leader; orphan collection then reconciles STORAGE_DIR against the database,
+# once per host, or once for the whole cluster when the volume is shared
+STORAGE_GC_LEASE = "storage-gc" if STORAGE_SHARED else f"storage-gc:{socket.gethostname()}"
+
+async def touch_image(session_id: str, image: Dict[str, Any]):
+    """Record an access for LRU eviction, at most once per ACCESS_TOUCH_SECONDS."""
+    now = datetime.utcnow()
+    last = image.get("last_accessed_at") or image.get("created_at")
+    if last and now - last < timedelta(seconds=ACCESS_TOUCH_SECONDS):
+        return
+    await db.generation_sessions.update_one(
+        {"id": session_id},
+        {"$set": {"images.$[img].last_accessed_at": now}},
+        array_filters=[{"img.id": image["id"]}]
+    )
+
+def _completed_images_pipeline(match: Dict[str, Any], sort_field: Optional[str] = None) -> List[Dict[str, Any]]:
+    image_match = {f"images.{key}": value for key, value in match.items()}
+    pipeline = [
+        {"$match": {"images": {"$elemMatch": {"status": "completed", **match}}}},
+        {"$unwind": "$images"},
+        {"$match": {"images.status": "completed", **image_match}},
+    ]
+    if sort_field:
+        pipeline.append({"$sort": {f"images.{sort_field}": 1}})
+    pipeline.append({"$project": {
+        "_id": 0,
+        "id": "$images.id",
+        "local_path": "$images.local_path",
+        "size_bytes": "$images.size_bytes"
+    }})
+    return pipeline
+
+def _remove_files(paths: List[str]) -> int:
+    reclaimed = 0
+    for path in paths:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            reclaimed += size
+        except FileNotFoundError:
+            continue
+    return reclaimed
+
+async def _evict_images(pipeline: List[Dict[str, Any]], budget_bytes: Optional[float] = None) -> Dict[str, int]:
+    """Evict images yielded by pipeline, in batches, until budget_bytes have been released."""
+    stats = {"images_evicted": 0, "bytes_evicted": 0, "bytes_reclaimed": 0}
+    batch: List[Dict[str, Any]] = []
+
+    async def _flush():
+        ids = [image["id"] for image in batch]
+        # local_path is kept so other hosts' copies are recognised as orphans
+        await db.generation_sessions.update_many(
+            {"images.id": {"$in": ids}},
+            {"$set": {"images.$[img].status": "evicted", "updated_at": datetime.utcnow()}},
+            array_filters=[{"img.id": {"$in": ids}}]
+        )
+        stats["images_evicted"] += len(batch)
+        stats["bytes_reclaimed"] += await asyncio.to_thread(
+            _remove_files, [image["local_path"] for image in batch if image.get("local_path")]
+        )
+        batch.clear()
+
+    async for image in db.generation_sessions.aggregate(pipeline, allowDiskUse=True):
+        if budget_bytes is not None and stats["bytes_evicted"] >= budget_bytes:
+            break
+        batch.append(image)
+        stats["bytes_evicted"] += image.get("size_bytes") or 0
+        if len(batch) >= STORAGE_GC_BATCH_SIZE:
+            await _flush()
+    if batch:
+        await _flush()
+    return stats
+
+async def save_storage_report(task: str, stats: Dict[str, Any]):
+    host = socket.gethostname()
+    report = {"_id": f"{task}:{host}", "task": task, "host": host, **stats, "finished_at": datetime.utcnow()}
+    await db.storage_reports.replace_one({"_id": report["_id"]}, report, upsert=True)
+    logging.info(f"Storage {task} on {host}: {stats}")
+
+async def enforce_storage_limits():
+    """Evict images past IMAGE_TTL_DAYS, then least recently used ones over the quotas."""
+    started = time.monotonic()
+    totals = {"images_evicted": 0, "bytes_evicted": 0, "bytes_reclaimed": 0}
+
+    def _add(stats):
+        for key, value in stats.items():
+            totals[key] += value
+
+    if IMAGE_TTL_DAYS > 0:
+        cutoff = datetime.utcnow() - timedelta(days=IMAGE_TTL_DAYS)
+        _add(await _evict_images(_completed_images_pipeline({"created_at": {"$lt": cutoff}})))
+
+    if USER_QUOTA_MB > 0 or GLOBAL_QUOTA_MB > 0:
+        usage = await db.generation_sessions.aggregate([
+            {"$match": {"images.status": "completed"}},
+            {"$unwind": "$images"},
+            {"$match": {"images.status": "completed"}},
+            {"$group": {"_id": "$owner", "bytes": {"$sum": "$images.size_bytes"}}}
+        ], allowDiskUse=True).to_list(None)
+        total_bytes = sum(entry["bytes"] for entry in usage)
+
+        if USER_QUOTA_MB > 0:
+            quota = USER_QUOTA_MB * 1024 * 1024
+            for entry in usage:
+                if entry["_id"] and entry["bytes"] > quota:
+                    stats = await _evict_images(
+                        [{"$match": {"owner": entry["_id"]}}] + _completed_images_pipeline({}, "last_accessed_at"),
+                        entry["bytes"] - quota
+                    )
+                    total_bytes -= stats["bytes_evicted"]
+                    _add(stats)
+
+        if GLOBAL_QUOTA_MB > 0 and total_bytes > GLOBAL_QUOTA_MB * 1024 * 1024:
+            _add(await _evict_images(
+                _completed_images_pipeline({}, "last_accessed_at"),
+                total_bytes - GLOBAL_QUOTA_MB * 1024 * 1024
+            ))
+
+    totals["duration_seconds"] = round(time.monotonic() - started, 3)
+    await save_storage_report("eviction", totals)
+
+def _next_gc_candidates(entries, limit: int, cutoff: float) -> Optional[Tuple[int, List[Tuple[str, int]]]]:
+    """Pull up to limit directory entries and return (pulled, candidates); None once the scan is exhausted."""
+    candidates = []
+    pulled = 0
+    for entry in entries:
+        pulled += 1
+        try:
+            if entry.is_file(follow_symlinks=False):
+                info = entry.stat(follow_symlinks=False)
+                # Younger files may belong to a generation that has not saved its images yet
+                if info.st_mtime < cutoff:
+                    candidates.append((entry.path, info.st_size))
+        except OSError:
+            # Renamed or removed since the directory was listed, e.g. a finished .part download
+            pass
+        if pulled >= limit:
+            return pulled, candidates
+    return (pulled, candidates) if pulled else None
+
+async def collect_orphans():
+    """Delete files in STORAGE_DIR that no completed image references, plus stale partial downloads."""
+    started = time.monotonic()
+    stats = {"files_scanned": 0, "files_removed": 0, "partial_removed": 0, "bytes_reclaimed": 0}
+    cutoff = time.time() - ORPHAN_GRACE_SECONDS
+    entries = os.scandir(STORAGE_DIR)
+    try:
+        while True:
+            scanned = await asyncio.to_thread(_next_gc_candidates, entries, STORAGE_GC_BATCH_SIZE, cutoff)
+            if scanned is None:
+                break
+            pulled, batch = scanned
+            stats["files_scanned"] += pulled
+            partial = [path for path, _ in batch if path.endswith(PARTIAL_SUFFIX)]
+            paths = [path for path, _ in batch if not path.endswith(PARTIAL_SUFFIX)]
+            live = set()
+            if paths:
+                async for doc in db.generation_sessions.aggregate([
+                    {"$match": {"images.local_path": {"$in": paths}}},
+                    {"$unwind": "$images"},
+                    {"$match": {"images.local_path": {"$in": paths}, "images.status": "completed"}},
+                    {"$project": {"_id": 0, "path": "$images.local_path"}}
+                ]):
+                    live.add(doc["path"])
+            orphans = [path for path in paths if path not in live]
+            stats["bytes_reclaimed"] += await asyncio.to_thread(_remove_files, orphans + partial)
+            stats["files_removed"] += len(orphans)
+            stats["partial_removed"] += len(partial)
+    finally:
+        entries.close()
+    stats["duration_seconds"] = round(time.monotonic() - started, 3)
+    await save_storage_report("orphan_gc", stats)
+
+async def storage_gc_loop():
+    while True:
+        try:
+            await run_with_lease(STORAGE_GC_LEASE, STORAGE_GC_INTERVAL_SECONDS * 2, collect_orphans)
+        except Exception as e:
+            logging.error(f"Orphan collection failed: {str(e)}")
+        await asyncio.sleep(STORAGE_GC_INTERVAL_SECONDS)
+
+async def storage_eviction_loop():
+    # Eviction scans every image, so it holds its own lease instead of delaying
+    # the scheduler's short tasks, and two workers never evict the same overage
+    while True:
+        try:
+            await run_with_lease("storage-eviction", STORAGE_GC_INTERVAL_SECONDS * 2, enforce_storage_limits)
+        except Exception as e:
+            logging.error(f"Storage eviction failed: {str(e)}")
+        await asyncio.sleep(STORAGE_GC_INTERVAL_SECONDS)
+
+# Templated batches are expanded into sessions and jobs a chunk at a time, only
+# while the batch has little queued work, so a 100k prompt batch never sits in
+# memory or in the queue all at once. Session and job ids are derived from the
+# batch position, so a chunk interrupted half way is simply expanded again
+def template_permutation(combinations: int, sample: bool, seed: Optional[int] = None) -> Tuple[int, int]:
+    """Return (stride, offset) mapping batch positions to combination indexes.
+
+    Sampling walks an affine permutation of the combination indexes, so any
+    prompt can be produced from its position without listing the others; a
+    stride coprime with the number of combinations visits each index once.
+    """
+    if not sample or combinations <= 1:
+        return 1, 0
+    rng = random.Random(seed)
+    stride = rng.randrange(1, combinations)
+    while math.gcd(stride, combinations) != 1:
+        stride = rng.randrange(1, combinations)
+    return stride, rng.randrange(combinations)
+
+def render_template_prompt(batch: Dict[str, Any], position: int) -> str:
+    index = (batch["stride"] * position + batch["offset"]) % batch["combinations"]
+    values = {}
+    # Mixed-radix decoding: the last variable varies fastest, like itertools.product
+    for name in reversed(list(batch["variables"])):
+        options = batch["variables"][name]
+        index, choice = divmod(index, len(options))
+        values[name] = options[choice]
+    return TEMPLATE_PLACEHOLDER.sub(lambda match: values[match.group(1)], batch["template"])
+
+def template_item_id(batch_id: str, position: int, kind: str) -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"pixel:template:{batch_id}:{position}:{kind}"))
+
+async def insert_missing(collection, documents: List[Dict[str, Any]]):
+    """Insert documents, skipping any whose unique id is already stored."""
+    try:
+        await collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        if any(error["code"] != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+
+async def expand_template_batch(batch: Dict[str, Any]):
+    queued = await db.generation_jobs.count_documents(
+        {"batch_id": batch["id"], "status": "queued"}, limit=EXPAND_LOW_WATERMARK
+    )
+    if queued >= EXPAND_LOW_WATERMARK:
+        return
+
+    start = batch["expanded"]
+    end = min(start + EXPAND_CHUNK_SIZE, batch["total"])
+    positions = []
+    sessions = []
+    for position in range(start, end):
+        prompt = render_template_prompt(batch, position)
+        if prompt.strip():
+            positions.append(position)
+            sessions.append(GenerationSession(
+                id=template_item_id(batch["id"], position, "session"),
+                prompt=prompt,
+                owner=batch["client_key"],
+                batch_id=batch["id"],
+                batch_position=position,
+                styles=batch["styles"],
+                images_per_style=batch["images_per_style"],
+                total_images=len(batch["styles"] or [None]) * batch["images_per_style"]
+            ))
+    if sessions:
+        await insert_missing(db.generation_sessions, [session.dict() for session in sessions])
+        cost = job_cost(batch["styles"], batch["images_per_style"])
+        tags = await assign_fair_share_tags(batch["client_key"], "batch", [cost] * len(sessions))
+        await insert_missing(db.generation_jobs, [
+            new_job(
+                session, batch["auth_cookie"], batch["client_key"], "batch", tag, batch["deadline_at"],
+                job_id=template_item_id(batch["id"], position, "job")
+            )
+            for position, session, tag in zip(positions, sessions, tags)
+        ])
+        await response_cache.invalidate("sessions")
+
+    # Advance the cursor only once the chunk is stored; if another leader already
+    # moved it, this no-ops and the duplicate inserts above were skipped
+    update: Dict[str, Any] = {"$set": {"expanded": end}}
+    if end >= batch["total"]:
+        update = {"$set": {"status": "expanded", "expanded": end}, "$unset": {"auth_cookie": ""}}
+    await db.template_batches.update_one(
+        {"id": batch["id"], "status": "expanding", "expanded": start}, update
+    )
+
+async def expand_template_batches():
+    # Re-expanding a chunk relies on the unique id indexes to skip what was stored
+    if not app_state["indexes_ready"]:
+        return
+    now = datetime.utcnow()
+    await db.template_batches.update_many(
+        {"status": "expanding", "deadline_at": {"$lte": now}},
+        {"$set": {"status": "expired"}, "$unset": {"auth_cookie": ""}}
+    )
+    async for batch in db.template_batches.find({"status": "expanding"}).sort("created_at", 1):
+        await expand_template_batch(batch)
+
+# Singleton maintenance tasks run only on the elected leader: (name, interval seconds, coroutine)
+SINGLETON_TASKS = [
+    ("requeue_stale_jobs", JOB_LEASE_SECONDS / 2, requeue_stale_jobs),
+    ("expire_overdue_jobs", 30, expire_overdue_jobs),
+    ("expand_template_batches", 5, expand_template_batches),
+]
+
+async def leader_loop():
+    last_run: Dict[str, float] = {}
+
+    async def run_due_tasks():
+        for name, interval, task in SINGLETON_TASKS:
+            if time.monotonic() - last_run.get(name, float("-inf")) >= interval:
+                last_run[name] = time.monotonic()
+                try:
+                    await task()
+                except Exception as e:
+                    logging.error(f"Singleton task {name} failed: {str(e)}")
+
+    while True:
+        try:
+            # The lease is renewed while tasks run, and they are stopped if it is lost
+            if not await run_with_lease("scheduler", LEADER_LEASE_SECONDS, run_due_tasks):
+                last_run.clear()
+        except Exception as e:
+            logging.error(f"Leader election failed: {str(e)}")
+        await asyncio.sleep(LEADER_LEASE_SECONDS / 3)
+
+background_loops: List[asyncio.Task] = []
+# Job tasks of this worker, so shutdown can stop them before requeueing their jobs
+running_jobs: Dict[asyncio.Task, str] = {}
 
 # Include the router in the main app
 app.include_router(api_router)
@@ -478,6 +1981,72 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+async def ensure_indexes():
+    """Create indexes in the background, retrying until MongoDB is reachable."""
+    delay = 1
+    while True:
+        try:
+            await coordination.setup()
+            await db.generation_jobs.create_index([("status", 1), ("priority", 1), ("virtual_finish", 1), ("created_at", 1)])
+            await db.generation_jobs.create_index([("status", 1), ("finished_at", 1)])
+            await db.scheduler_state.create_index("expires_at", expireAfterSeconds=0)
+            await db.generation_jobs.create_index("id", unique=True)
+            await db.generation_sessions.create_index("id", unique=True)
+            await db.generation_sessions.create_index([("updated_at", 1), ("id", 1)])
+            await db.generation_sessions.create_index("images.id")
+            await db.generation_sessions.create_index("images.local_path")
+            await db.generation_sessions.create_index([("batch_id", 1), ("batch_position", 1)], sparse=True)
+            await db.generation_jobs.create_index([("batch_id", 1), ("status", 1)], sparse=True)
+            await db.template_batches.create_index([("status", 1), ("created_at", 1)])
+            app_state["indexes_ready"] = True
+            return
+        except Exception as e:
+            logging.warning(f"Index setup failed, retrying in {delay}s: {str(e)}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+async def start_app():
+    global client, db, coordination
+    STORAGE_DIR.mkdir(parents=True, exist_ok=True)
+    # Motor connects lazily, so this returns without waiting on MongoDB
+    client = AsyncIOMotorClient(mongo_url, serverSelectionTimeoutMS=MONGO_TIMEOUT_MS)
+    db = client[os.environ['DB_NAME']]
+    coordination = create_coordination()
+    background_loops.append(asyncio.create_task(ensure_indexes()))
+    background_loops.append(asyncio.create_task(worker_presence_loop()))
+    background_loops.append(asyncio.create_task(job_worker_loop()))
+    background_loops.append(asyncio.create_task(leader_loop()))
+    background_loops.append(asyncio.create_task(storage_gc_loop()))
+    background_loops.append(asyncio.create_task(storage_eviction_loop()))
+    logging.info(f"Worker {WORKER_ID} started with {JOB_CONCURRENCY} job slots")
+
+async def stop_app():
+    for task in background_loops:
+        task.cancel()
+    stopped_jobs = []
+    jobs = dict(running_jobs)
+    if jobs:
+        for task in jobs:
+            task.cancel()
+        done, _ = await asyncio.wait(list(jobs), timeout=JOB_SHUTDOWN_TIMEOUT_SECONDS)
+        # Jobs whose task did not stop in time are left to lease expiry so they never run twice at once
+        stopped_jobs = [jobs[task] for task in done]
+    try:
+        # Hand stopped jobs straight back so a rolling deploy does not wait for lease expiry
+        if stopped_jobs:
+            await db.generation_jobs.update_many(
+                {"id": {"$in": stopped_jobs}, "status": "running", "worker_id": WORKER_ID},
+                {
+                    "$set": {"status": "queued", "worker_id": None, "lease_expires_at": None},
+                    "$inc": {"attempts": -1}
+                }
+            )
+        await db.scheduler_state.delete_one({"_id": f"worker:{WORKER_ID}"})
+        await coordination.release_lease("scheduler", WORKER_ID)
+        await coordination.release_lease(STORAGE_GC_LEASE, WORKER_ID)
+        await coordination.release_lease("storage-eviction", WORKER_ID)
+    except Exception as e:
+        logging.error(f"Shutdown cleanup failed: {str(e)}")
+    if _http_adapter is not None:
+        _http_adapter.close()
+    client.close()
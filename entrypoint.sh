@@ -4,38 +4,103 @@ set -e
 # Start the FastAPI backend
 cd /backend || { echo "Backend directory not found"; exit 1; }
 
-echo "Starting FastAPI backend"
-# Start Uvicorn with proper host binding
-uvicorn server:app --host 0.0.0.0 --port 8001 &
-BACKEND_PID=$!
+# Number of uvicorn processes in this container; each one runs its own job
+# worker loop and they coordinate through MongoDB (or Redis when REDIS_URL is set)
+BACKEND_WORKERS=${BACKEND_WORKERS:-$(nproc 2>/dev/null || echo 1)}
+BACKEND_BASE_PORT=${BACKEND_BASE_PORT:-8001}
+UPSTREAM_CONF=/etc/nginx/backend_upstream.conf
 
-echo "Waiting for backend to start..."
-sleep 30
-
-if ! kill -0 $BACKEND_PID 2>/dev/null; then
-    echo "Backend failed to start at initialization, exiting"
+# Images are saved by the worker that ran the job and read by whichever worker
+# nginx picks, so containers listed in BACKEND_UPSTREAMS must all mount one
+# shared volume at STORAGE_DIR and run with STORAGE_SHARED=true
+export STORAGE_DIR=${STORAGE_DIR:-/tmp/pixel_images}
+if [ -n "$BACKEND_UPSTREAMS" ] && [ "$STORAGE_SHARED" != "true" ]; then
+    echo "BACKEND_UPSTREAMS needs a shared volume at $STORAGE_DIR and STORAGE_SHARED=true, exiting"
     exit 1
 fi
 
+echo "Starting FastAPI backend with $BACKEND_WORKERS workers"
+BACKEND_PIDS=""
+i=0
+while [ "$i" -lt "$BACKEND_WORKERS" ]; do
+    port=$((BACKEND_BASE_PORT + i))
+    # Start Uvicorn with proper host binding
+    uvicorn server:app --host 0.0.0.0 --port "$port" &
+    BACKEND_PIDS="$BACKEND_PIDS $!"
+    i=$((i + 1))
+done
+
+# Balance across the local workers, or across containers when
+# BACKEND_UPSTREAMS lists host:port pairs (space or comma separated)
+{
+    echo "upstream backend {"
+    echo "    least_conn;"
+    if [ -n "$BACKEND_UPSTREAMS" ]; then
+        for server in $(echo "$BACKEND_UPSTREAMS" | tr ',' ' '); do
+            echo "    server $server max_fails=3 fail_timeout=10s;"
+        done
+    else
+        i=0
+        while [ "$i" -lt "$BACKEND_WORKERS" ]; do
+            echo "    server 127.0.0.1:$((BACKEND_BASE_PORT + i)) max_fails=3 fail_timeout=10s;"
+            i=$((i + 1))
+        done
+    fi
+    echo "    keepalive 32;"
+    echo "}"
+} > "$UPSTREAM_CONF"
+
+# Poll readiness instead of sleeping a fixed time; nginx starts as soon as
+# every local worker reports ready (MongoDB reachable, indexes in place)
+STARTUP_TIMEOUT=${STARTUP_TIMEOUT:-120}
+echo "Waiting for backend to become ready..."
+started=$(date +%s)
+for port_offset in $(seq 0 $((BACKEND_WORKERS - 1))); do
+    port=$((BACKEND_BASE_PORT + port_offset))
+    until wget -q -O /dev/null "http://127.0.0.1:$port/api/health/ready" 2>/dev/null; do
+        for pid in $BACKEND_PIDS; do
+            if ! kill -0 "$pid" 2>/dev/null; then
+                echo "Backend failed to start at initialization, exiting"
+                kill $BACKEND_PIDS 2>/dev/null || true
+                exit 1
+            fi
+        done
+        if [ $(( $(date +%s) - started )) -ge "$STARTUP_TIMEOUT" ]; then
+            echo "Backend not ready after ${STARTUP_TIMEOUT}s, exiting"
+            kill $BACKEND_PIDS 2>/dev/null || true
+            exit 1
+        fi
+        sleep 0.5
+    done
+done
+echo "Backend ready after $(( $(date +%s) - started ))s"
+
 # Start Nginx
 nginx -g 'daemon off;' &
 NGINX_PID=$!
 
 # Handle termination signals
-trap 'kill $BACKEND_PID $NGINX_PID; exit 0' SIGTERM SIGINT
+trap 'kill $BACKEND_PIDS $NGINX_PID; exit 0' SIGTERM SIGINT
+
+backends_alive() {
+    for pid in $BACKEND_PIDS; do
+        kill -0 "$pid" 2>/dev/null || return 1
+    done
+    return 0
+}
 
 # Check if processes are still running
-while kill -0 $BACKEND_PID 2>/dev/null && kill -0 $NGINX_PID 2>/dev/null; do
+while backends_alive && kill -0 $NGINX_PID 2>/dev/null; do
     sleep 1
 done
 
 # If we get here, one of the processes died
-if kill -0 $BACKEND_PID 2>/dev/null; then
+if backends_alive; then
     echo "Nginx died, shutting down backend..."
-    kill $BACKEND_PID
+    kill $BACKEND_PIDS
 else
-    echo "Backend died, shutting down nginx..."
-    kill $NGINX_PID
+    echo "A backend worker died, shutting down..."
+    kill $BACKEND_PIDS $NGINX_PID 2>/dev/null || true
 fi
 
 exit 1
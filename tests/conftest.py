@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# server.py is run from backend/ by uvicorn, so import it the same way
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
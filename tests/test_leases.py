@@ -0,0 +1,68 @@
+import asyncio
+
+import server
+
+
+class Leases:
+    """Coordination stand-in whose lease answers are scripted per call."""
+
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.calls = 0
+
+    async def acquire_lease(self, name, owner, ttl):
+        self.calls += 1
+        answer = self.answers.pop(0) if self.answers else True
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+def test_task_is_skipped_when_another_worker_holds_the_lease(monkeypatch):
+    monkeypatch.setattr(server, "coordination", Leases([False]))
+    ran = []
+
+    async def task():
+        ran.append(True)
+
+    assert not asyncio.run(server.run_with_lease("scheduler", 3, task))
+    assert not ran
+
+
+def test_long_task_keeps_renewing_the_lease(monkeypatch):
+    leases = Leases([True])
+    monkeypatch.setattr(server, "coordination", leases)
+
+    async def task():
+        await asyncio.sleep(0.05)
+        return "done"
+
+    assert asyncio.run(server.run_with_lease("scheduler", 0.03, task))
+    assert leases.calls >= 3
+
+
+def test_task_stops_once_the_lease_is_lost(monkeypatch):
+    monkeypatch.setattr(server, "coordination", Leases([True, True, False]))
+    progress = []
+
+    async def task():
+        for step in range(100):
+            progress.append(step)
+            await asyncio.sleep(0.01)
+
+    asyncio.run(server.run_with_lease("storage-eviction", 0.03, task))
+    assert len(progress) < 100
+
+
+def test_task_stops_when_renewal_keeps_failing(monkeypatch):
+    monkeypatch.setattr(server, "coordination", Leases([True] + [ConnectionError("down")] * 10))
+    progress = []
+
+    async def task():
+        for step in range(100):
+            progress.append(step)
+            await asyncio.sleep(0.01)
+
+    asyncio.run(server.run_with_lease("scheduler", 0.06, task))
+    # The last renewal is trusted for at most two thirds of the lease
+    assert len(progress) < 10
@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+import server
+
+
+def connection_refused():
+    reason = NewConnectionError(None, "Connection refused")
+    return requests.ConnectionError(MaxRetryError(None, "https://www.bing.com", reason))
+
+
+def test_submit_retries_only_when_nothing_was_sent():
+    policy = server.RETRY_POLICIES["submit"]
+    assert server.should_retry(policy, connection_refused())
+    assert server.should_retry(policy, requests.ConnectTimeout())
+    assert not server.should_retry(policy, server.UpstreamError("HTTP 503", 503))
+    assert not server.should_retry(policy, server.UpstreamError("HTTP 502", 502))
+    assert not server.should_retry(policy, server.UpstreamError("HTTP 504", 504, retry_after=1))
+    assert not server.should_retry(policy, requests.ReadTimeout())
+    assert not server.should_retry(policy, requests.ConnectionError("Connection reset by peer"))
+
+
+def test_submit_retries_a_rejection_only_when_told_when_to_come_back():
+    policy = server.RETRY_POLICIES["submit"]
+    assert server.should_retry(policy, server.UpstreamError("HTTP 429", 429, retry_after=2))
+    assert server.should_retry(policy, server.UpstreamError("HTTP 503", 503, retry_after=0))
+    assert not server.should_retry(policy, server.UpstreamError("HTTP 429", 429))
+    too_late = policy["backoff_max"] + 1
+    assert not server.should_retry(policy, server.UpstreamError("HTTP 503", 503, retry_after=too_late))
+
+
+def test_idempotent_calls_retry_any_request_error():
+    policy = server.RETRY_POLICIES["preload"]
+    assert server.should_retry(policy, requests.ReadTimeout())
+    assert server.should_retry(policy, requests.ConnectionError("Connection reset by peer"))
+    assert server.should_retry(policy, server.UpstreamError("HTTP 502", 502))
+    assert not server.should_retry(policy, ValueError("Prompt blocked"))
+
+
+def opened_breaker():
+    breaker = server.CircuitBreaker("test", failure_threshold=2, reset_seconds=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    return breaker
+
+
+def expire_reset_window(breaker):
+    breaker.opened_at -= breaker.reset_seconds
+
+
+def test_breaker_opens_after_threshold_and_rejects_calls():
+    breaker = server.CircuitBreaker("test", failure_threshold=2, reset_seconds=30)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    assert breaker.before_call() is False
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.available()
+    with pytest.raises(server.CircuitOpenError):
+        breaker.before_call()
+
+
+def test_half_open_allows_a_single_trial():
+    breaker = opened_breaker()
+    expire_reset_window(breaker)
+    assert breaker.available()
+
+    assert breaker.before_call() is True
+    assert breaker.state == "half_open"
+    # Workers must not claim jobs while the probe is still running
+    assert not breaker.available()
+    with pytest.raises(server.CircuitOpenError):
+        breaker.before_call()
+
+
+def test_successful_trial_closes_the_breaker():
+    breaker = opened_breaker()
+    expire_reset_window(breaker)
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.failures == 0
+    assert breaker.available()
+
+
+def test_failed_trial_reopens_the_breaker():
+    breaker = opened_breaker()
+    expire_reset_window(breaker)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.available()
+
+
+def test_cancelled_trial_does_not_wedge_the_breaker():
+    breaker = opened_breaker()
+    expire_reset_window(breaker)
+
+    async def hang(timeout):
+        await asyncio.sleep(3600)
+
+    async def cancel_trial():
+        task = asyncio.create_task(server.resilient_call("poll", breaker, hang))
+        await asyncio.sleep(0)
+        assert not breaker.available()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_trial())
+    assert not breaker.trial_in_flight
+    assert breaker.available()
+    assert breaker.before_call() is True
@@ -0,0 +1,127 @@
+import asyncio
+
+from starlette.requests import Request
+
+import server
+
+
+class SharedVersions:
+    """Stands in for the coordination store that every worker shares."""
+
+    def __init__(self):
+        self.versions = {}
+        self.lookups = 0
+
+    async def get_version(self, name):
+        self.lookups += 1
+        return self.versions.get(name, 0)
+
+    async def bump_version(self, name):
+        self.versions[name] = self.versions.get(name, 0) + 1
+        return self.versions[name]
+
+
+def test_invalidation_reaches_other_workers(monkeypatch):
+    monkeypatch.setattr(server, "coordination", SharedVersions())
+    monkeypatch.setattr(server, "CACHE_VERSION_SECONDS", 0)
+    worker_a = server.ResponseCache(16)
+    worker_b = server.ResponseCache(16)
+    value = {"theme": "dark"}
+
+    async def produce():
+        return dict(value)
+
+    async def scenario():
+        first, _ = await worker_b.fetch("settings:1", "", 60, produce)
+        value["theme"] = "light"
+        await worker_a.invalidate("settings:1")
+        second, _ = await worker_b.fetch("settings:1", "", 60, produce)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert b"dark" in first
+    assert b"light" in second
+
+
+def test_waiters_recover_when_the_producer_is_cancelled(monkeypatch):
+    monkeypatch.setattr(server, "coordination", SharedVersions())
+    cache = server.ResponseCache(16)
+    calls = []
+
+    async def produce():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            await asyncio.sleep(3600)
+        return {"call": len(calls)}
+
+    async def scenario():
+        producer = asyncio.create_task(cache.fetch("sessions", "k", 60, produce))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.fetch("sessions", "k", 60, produce))
+        await asyncio.sleep(0)
+        producer.cancel()
+        return await asyncio.wait_for(waiter, 1)
+
+    body, _ = asyncio.run(scenario())
+    assert body == b'{"call":2}'
+    assert not cache.inflight
+
+
+def test_cache_is_bypassed_without_a_version(monkeypatch):
+    class Unreachable(SharedVersions):
+        async def get_version(self, name):
+            raise ConnectionError("store down")
+
+    monkeypatch.setattr(server, "coordination", Unreachable())
+    cache = server.ResponseCache(16)
+    count = []
+
+    async def produce():
+        count.append(1)
+        return {"n": len(count)}
+
+    async def scenario():
+        await cache.fetch("sessions", "k", 60, produce)
+        return await cache.fetch("sessions", "k", 60, produce)
+
+    body, _ = asyncio.run(scenario())
+    assert body == b'{"n":2}'
+    assert not cache.entries
+
+
+def test_hits_reuse_the_version_for_a_short_interval(monkeypatch):
+    shared = SharedVersions()
+    monkeypatch.setattr(server, "coordination", shared)
+    monkeypatch.setattr(server, "CACHE_VERSION_SECONDS", 60)
+    cache = server.ResponseCache(16)
+    value = {"theme": "dark"}
+
+    async def produce():
+        return dict(value)
+
+    async def scenario():
+        for _ in range(5):
+            await cache.fetch("settings:1", "", 60, produce)
+        value["theme"] = "light"
+        # The invalidating worker sees its own write straight away
+        await cache.invalidate("settings:1")
+        body, _ = await cache.fetch("settings:1", "", 60, produce)
+        return body
+
+    assert b"light" in asyncio.run(scenario())
+    assert shared.lookups == 1
+
+
+def test_styles_are_served_without_the_coordination_store(monkeypatch):
+    class Unreachable:
+        def __getattr__(self, name):
+            raise AssertionError(f"styles touched coordination.{name}")
+
+    monkeypatch.setattr(server, "coordination", Unreachable())
+    request = Request({"type": "http", "headers": []})
+    response = asyncio.run(server.get_styles(request))
+    assert response.status_code == 200
+    assert response.body == server.STYLES_BODY
+
+    revalidation = Request({"type": "http", "headers": [(b"if-none-match", server.STYLES_ETAG.encode())]})
+    assert asyncio.run(server.get_styles(revalidation)).status_code == 304
@@ -0,0 +1,141 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+class Cursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length):
+        return self.docs
+
+
+class SchedulerState:
+    def __init__(self, docs=None):
+        self.docs = {doc["_id"]: doc for doc in docs or []}
+
+    async def find_one(self, query):
+        return self.docs.get(query["_id"])
+
+    def find(self, query, projection=None):
+        prefix = query["_id"]["$regex"].lstrip("^")
+        now = query["expires_at"]["$gt"]
+        return Cursor([
+            doc for key, doc in self.docs.items() if key.startswith(prefix) and doc["expires_at"] > now
+        ])
+
+    async def find_one_and_update(self, query, pipeline, upsert, return_document):
+        # Mirrors the single pipeline stage used by assign_fair_share_tags
+        stage = pipeline[0]["$set"]
+        floor_expr, total = stage["finish"]["$add"]
+        vtime = floor_expr["$max"][1]
+        doc = self.docs.setdefault(query["_id"], {"_id": query["_id"]})
+        doc["finish"] = max(doc.get("finish", 0), vtime) + total
+        return doc
+
+
+class Jobs:
+    def __init__(self, queued=(), durations=()):
+        self.queued = list(queued)
+        self.durations = list(durations)
+
+    async def count_documents(self, query):
+        higher, same = query["$or"]
+        return sum(
+            1 for priority, finish in self.queued
+            if priority < higher["priority"]["$lt"]
+            or (priority == same["priority"] and finish < same["virtual_finish"]["$lt"])
+        )
+
+    def aggregate(self, pipeline):
+        if not self.durations:
+            return Cursor([])
+        return Cursor([{"_id": None, "ms": 1000 * sum(self.durations) / len(self.durations)}])
+
+
+class FakeDb:
+    def __init__(self, scheduler_state=None, jobs=None):
+        self.scheduler_state = scheduler_state or SchedulerState()
+        self.generation_jobs = jobs or Jobs()
+
+
+def workers(count, slots=2, expired=0):
+    now = datetime.utcnow()
+    docs = [{"_id": f"worker:w{i}", "slots": slots, "expires_at": now + timedelta(seconds=60)} for i in range(count)]
+    docs += [
+        {"_id": f"worker:gone{i}", "slots": slots, "expires_at": now - timedelta(seconds=1)} for i in range(expired)
+    ]
+    return docs
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    def install(**kwargs):
+        db = FakeDb(**kwargs)
+        monkeypatch.setattr(server, "db", db)
+        monkeypatch.setattr(server, "_throughput_cache", {"at": float("-inf"), "value": 0.0})
+        return db
+    return install
+
+
+def test_throughput_counts_every_live_worker(fake_db):
+    fake_db(scheduler_state=SchedulerState(workers(8, expired=3)), jobs=Jobs(durations=[40, 60]))
+    assert asyncio.run(server.recent_throughput()) == pytest.approx(16 / 50)
+
+
+def test_throughput_falls_back_to_this_worker_and_the_assumed_duration(fake_db):
+    fake_db()
+    expected = server.JOB_CONCURRENCY / server.ASSUMED_JOB_SECONDS
+    assert asyncio.run(server.recent_throughput()) == pytest.approx(expected)
+
+
+def test_fair_share_tags_are_consecutive_and_follow_the_virtual_clock(fake_db):
+    db = fake_db(scheduler_state=SchedulerState([{"_id": "vtime:batch", "vtime": 10.0}]))
+    first = asyncio.run(server.assign_fair_share_tags("alice", "batch", [2, 4]))
+    assert first == [(10.0, 12.0), (12.0, 16.0)]
+    second = asyncio.run(server.assign_fair_share_tags("alice", "batch", [1]))
+    assert second == [(16.0, 17.0)]
+    db.scheduler_state.docs["vtime:batch"]["vtime"] = 30.0
+    assert asyncio.run(server.assign_fair_share_tags("alice", "batch", [1])) == [(30.0, 31.0)]
+
+
+def test_fair_share_weight_scales_tags(fake_db, monkeypatch):
+    monkeypatch.setitem(server.FAIR_SHARE_WEIGHTS, "vip", 4)
+    fake_db()
+    assert asyncio.run(server.assign_fair_share_tags("vip", "batch", [8, 8])) == [(0.0, 2.0), (2.0, 4.0)]
+
+
+def test_admit_scales_with_the_cluster(fake_db):
+    queued = [(0, 0.5)] * 40
+    fake_db(scheduler_state=SchedulerState(workers(10)), jobs=Jobs(queued=queued, durations=[60]))
+    # 20 slots of 60s jobs start 1/3 job per second, so 40 queued jobs wait 120s
+    assert asyncio.run(server.admit("bob", "interactive", 1, None)) == pytest.approx(120)
+
+
+def test_admit_rejects_work_past_its_deadline(fake_db):
+    queued = [(0, 0.5)] * 40
+    fake_db(jobs=Jobs(queued=queued, durations=[60]))
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(server.admit("bob", "interactive", 1, 60))
+    assert raised.value.status_code == 503
+    assert int(raised.value.headers["Retry-After"]) > 0
+
+
+def test_admit_judges_a_batch_by_its_last_job(fake_db):
+    fake_db(scheduler_state=SchedulerState(workers(1)), jobs=Jobs(durations=[10]))
+    # 2 slots of 10s jobs: the 21st job of the batch starts after 20 ahead of it
+    assert asyncio.run(server.admit("carol", "batch", 1, None, count=21)) == pytest.approx(100)
+    with pytest.raises(HTTPException):
+        asyncio.run(server.admit("carol", "batch", 1, 50, count=21))
+
+
+def test_admit_rejects_non_positive_deadlines(fake_db):
+    fake_db()
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(server.admit("bob", "batch", 1, 0))
+    assert raised.value.status_code == 400
@@ -0,0 +1,31 @@
+import os
+import time
+
+import server
+
+
+class VanishedEntry:
+    """A directory entry whose file was renamed away after scandir listed it."""
+
+    path = "/tmp/pixel_images/gone.png.part"
+
+    def is_file(self, follow_symlinks=True):
+        return True
+
+    def stat(self, follow_symlinks=True):
+        raise FileNotFoundError(2, "No such file or directory", self.path)
+
+
+def test_gc_scan_skips_files_that_disappear(tmp_path):
+    old = tmp_path / "old.png"
+    old.write_bytes(b"png")
+    os.utime(old, (0, 0))
+    with os.scandir(tmp_path) as entries:
+        listed = [VanishedEntry()] + list(entries)
+    pulled, candidates = server._next_gc_candidates(iter(listed), 10, time.time())
+    assert pulled == 2
+    assert candidates == [(str(old), 3)]
+
+
+def test_gc_scan_reports_exhaustion():
+    assert server._next_gc_candidates(iter([]), 10, time.time()) is None
@@ -0,0 +1,213 @@
+import asyncio
+import itertools
+import math
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+def make_batch(variables, template=None, stride=1, offset=0, total=None):
+    combinations = math.prod(len(values) for values in variables.values())
+    return {
+        "template": template or " ".join(f"{{{name}}}" for name in variables),
+        "variables": variables,
+        "combinations": combinations,
+        "total": total or combinations,
+        "stride": stride,
+        "offset": offset,
+    }
+
+
+def submit(**fields):
+    request = server.TemplateBatchRequest(**fields)
+    # Validation happens before the request or the database is touched
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(server.generate_template_batch(request, None))
+    return raised.value
+
+
+def test_render_follows_itertools_product_order():
+    variables = {"animal": ["cat", "dog"], "place": ["sea", "moon", "city"], "mood": ["calm", "wild"]}
+    batch = make_batch(variables, template="a {mood} {animal} on the {place}")
+    rendered = [server.render_template_prompt(batch, position) for position in range(batch["total"])]
+    expected = [
+        f"a {mood} {animal} on the {place}"
+        for animal, place, mood in itertools.product(*variables.values())
+    ]
+    assert rendered == expected
+
+
+def test_sampled_permutation_is_a_bijection():
+    variables = {"a": list("0123"), "b": list("012345"), "c": list("012")}
+    combinations = 4 * 6 * 3
+    stride, offset = server.template_permutation(combinations, True, seed=7)
+    assert math.gcd(stride, combinations) == 1
+    batch = make_batch(variables, stride=stride, offset=offset)
+    rendered = {server.render_template_prompt(batch, position) for position in range(combinations)}
+    assert rendered == {" ".join(values) for values in itertools.product(*variables.values())}
+
+
+def test_permutation_is_reproducible_from_the_seed():
+    combinations = 10**12
+    assert server.template_permutation(combinations, True, seed=42) == server.template_permutation(
+        combinations, True, seed=42
+    )
+    assert server.template_permutation(combinations, False, seed=42) == (1, 0)
+    assert server.template_permutation(1, True, seed=42) == (1, 0)
+
+
+def test_limit_takes_distinct_combinations():
+    variables = {"a": [str(i) for i in range(10)], "b": [str(i) for i in range(10)]}
+    stride, offset = server.template_permutation(100, True, seed=3)
+    limited = make_batch(variables, stride=stride, offset=offset, total=15)
+    prompts = [server.render_template_prompt(limited, position) for position in range(limited["total"])]
+    assert len(set(prompts)) == 15
+
+    first = make_batch(variables, total=15)
+    assert [server.render_template_prompt(first, position) for position in range(15)] == [
+        f"0 {i}" for i in range(10)
+    ] + [f"1 {i}" for i in range(5)]
+
+
+def test_rejects_combinations_beyond_int64():
+    variables = {f"v{i}": [str(j) for j in range(10)] for i in range(20)}
+    template = " ".join(f"{{{name}}}" for name in variables)
+    error = submit(template=template, variables=variables, limit=100, sample=True)
+    assert error.status_code == 400
+    assert "too many combinations" in error.detail
+
+
+@pytest.mark.parametrize("fields, detail", [
+    ({"template": "  ", "variables": {}}, "empty"),
+    ({"template": "a {animal}", "variables": {"animal": []}}, "animal"),
+    ({"template": "a {animal}", "variables": {"animal": ["cat"]}, "limit": 0}, "at least 1"),
+    ({"template": "a {animal}", "variables": {"animal": ["cat"]}, "images_per_style": 5}, "cannot exceed 4"),
+    ({
+        "template": "{a} {b}",
+        "variables": {"a": [str(i) for i in range(400)], "b": [str(i) for i in range(400)]},
+    }, "set a limit"),
+])
+def test_rejects_invalid_templates(fields, detail):
+    error = submit(**fields)
+    assert error.status_code == 400
+    assert detail in error.detail
+
+
+class FakeCollection:
+    def __init__(self, fail_inserts=0):
+        self.docs = {}
+        self.fail_inserts = fail_inserts
+
+    async def insert_many(self, documents, ordered=True):
+        if self.fail_inserts:
+            self.fail_inserts -= 1
+            raise ConnectionError("connection lost")
+        errors = []
+        for document in documents:
+            if document["id"] in self.docs:
+                errors.append({"code": 11000})
+            else:
+                self.docs[document["id"]] = document
+        if errors:
+            raise server.BulkWriteError({"writeErrors": errors})
+
+    async def count_documents(self, query, limit=0):
+        return sum(1 for doc in self.docs.values() if all(doc.get(k) == v for k, v in query.items()))
+
+    async def update_one(self, query, update):
+        for doc in self.docs.values():
+            if all(doc.get(k) == v for k, v in query.items()):
+                doc.update(update["$set"])
+                return
+
+
+class FakeDb:
+    def __init__(self, batch):
+        self.generation_sessions = FakeCollection()
+        self.generation_jobs = FakeCollection(fail_inserts=1)
+        self.template_batches = FakeCollection()
+        self.template_batches.docs[batch["id"]] = batch
+
+
+def test_interrupted_expansion_is_redone_without_duplicates(monkeypatch):
+    batch = make_batch({"animal": ["cat", "dog", "owl"]}, template="a {animal}")
+    batch.update(
+        id="batch-1", status="expanding", expanded=0, styles=[], images_per_style=1,
+        client_key="client", auth_cookie="_U=", deadline_at=None,
+    )
+    db = FakeDb(batch)
+
+    async def assign_tags(caller, priority_class, costs):
+        return [(0.0, cost) for cost in costs]
+
+    async def invalidate(namespace):
+        pass
+
+    monkeypatch.setattr(server, "db", db)
+    monkeypatch.setattr(server, "assign_fair_share_tags", assign_tags)
+    monkeypatch.setattr(server.response_cache, "invalidate", invalidate)
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(server.expand_template_batch(dict(batch)))
+    # Sessions were stored but the job insert failed, so the cursor stays put
+    assert len(db.generation_sessions.docs) == 3
+    assert batch["expanded"] == 0
+
+    asyncio.run(server.expand_template_batch(dict(batch)))
+    assert len(db.generation_sessions.docs) == 3
+    assert {job["session_id"] for job in db.generation_jobs.docs.values()} == set(db.generation_sessions.docs)
+    assert batch["expanded"] == 3
+    assert batch["status"] == "expanded"
+    assert sorted(session["batch_position"] for session in db.generation_sessions.docs.values()) == [0, 1, 2]
+
+
+class SortingCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, keys):
+        for field, direction in reversed(keys):
+            self.docs.sort(key=lambda doc: doc[field], reverse=direction < 0)
+        return self
+
+    def skip(self, count):
+        self.docs = self.docs[count:]
+        return self
+
+    def limit(self, count):
+        self.docs = self.docs[:count]
+        return self
+
+    async def to_list(self, length):
+        return self.docs
+
+
+def test_session_pages_neither_repeat_nor_drop_sessions(monkeypatch):
+    created_at = server.datetime.utcnow()
+    sessions = [
+        server.GenerationSession(
+            prompt=f"p{position}", styles=[], images_per_style=1, total_images=1,
+            batch_id="batch-1", batch_position=position, created_at=created_at
+        ).dict()
+        for position in reversed(range(7))
+    ]
+
+    class Sessions:
+        def find(self, query):
+            return SortingCursor([doc for doc in sessions if doc["batch_id"] == query["batch_id"]])
+
+    class Db:
+        generation_sessions = Sessions()
+
+    monkeypatch.setattr(server, "db", Db())
+
+    async def pages():
+        seen = []
+        for skip in range(0, 7, 3):
+            page = await server.get_template_batch_sessions("batch-1", skip=skip, limit=3)
+            seen.extend(session.prompt for session in page)
+        return seen
+
+    assert asyncio.run(pages()) == [f"p{position}" for position in range(7)]